@@ -0,0 +1,322 @@
+"""
+analytics.py
+
+This module provides a `StatsSnapshot` class holding the statistics
+database in columnar NumPy arrays, so that aggregations across all
+users and en passant opportunities run as vectorised passes instead
+of SQL GROUP BY queries on every request.
+
+Snapshots are cached per database and reloaded once older than
+`SNAPSHOT_TTL` seconds, so statistics may lag behind the database by
+up to that long. Reloads run in a background thread while the stale
+snapshot is still served, so only the first load of a database makes
+requests wait.
+
+Classes:
+    StatsSnapshot: Columnar copy of the users, user_stats and
+    user_urls tables with aggregation methods.
+
+Functions:
+    get_snapshot: Return the cached snapshot of a database.
+"""
+
+
+import threading
+import time
+
+import numpy as np
+
+from database_manager import Database
+
+
+# Seconds before a cached snapshot is reloaded from the database
+SNAPSHOT_TTL = 60
+# Width of the rating bands opportunities are grouped into
+RATING_BAND_WIDTH = 200
+# Stands in for unknown ratings in the rating column
+UNKNOWN_RATING = -1
+# Rows fetched and converted to arrays at a time when loading
+LOAD_CHUNK_SIZE = 50000
+
+
+def encode(values, codes):
+    """Encode values as integer codes into a lookup list.
+
+    Args:
+      values (list): The values to encode.
+      codes (dict): Values mapped to their codes, which new values
+      are added to.
+
+    Returns:
+      numpy.ndarray: The code of each value.
+    """
+    return np.fromiter(
+        (codes.setdefault(value, len(codes)) for value in values),
+        dtype=np.int64, count=len(values)
+    )
+
+
+def int_column(values):
+    """Return values as an array of integers."""
+    return np.array(values, dtype=np.int64)
+
+
+def rating_column(values):
+    """Return ratings as an array, with `UNKNOWN_RATING` for `None`."""
+    return np.fromiter(
+        (UNKNOWN_RATING if rating is None else rating for rating in values),
+        dtype=np.int64, count=len(values)
+    )
+
+
+def bool_column(values):
+    """Return values as an array of booleans."""
+    return np.array(values, dtype=bool)
+
+
+def percentages(numerators, denominators):
+    """Return numerators as percentages of non-zero denominators."""
+    return numerators / np.maximum(denominators, 1) * 100
+
+
+class StatsSnapshot:
+    """Columnar snapshot of the statistics database."""
+    def __init__(self, db):
+        """Load the snapshot from the database.
+
+        Args:
+          db (Database): The open database.
+        """
+        user_codes = {}
+        opponent_codes = {}
+        variant_codes = {}
+
+        def encode_users(values):
+            """Helper function to encode usernames as user codes."""
+            return encode(values, user_codes)
+
+        # One row per user
+        _, rated_games, casual_games = self._load_columns(db, '''
+        SELECT username, ratedGames, casualGames FROM users
+        ''', [encode_users, int_column, int_column])
+        games = rated_games + casual_games
+
+        # Sum accepted and declined over game types per user
+        stats_codes, accepted_nos, declined_nos = self._load_columns(db, '''
+        SELECT username, acceptedNo, declinedNo FROM user_stats
+        ''', [encode_users, int_column, int_column])
+        self.accepted_nos = np.bincount(
+            stats_codes, weights=accepted_nos, minlength=len(user_codes)
+        )
+        self.declined_nos = np.bincount(
+            stats_codes, weights=declined_nos, minlength=len(user_codes)
+        )
+        # Users with stats but missing from users table have no games
+        self.games = np.zeros(len(user_codes), dtype=np.int64)
+        self.games[:len(games)] = games
+
+        # One row per en passant opportunity
+        self.opponents, self.variants, self.ratings, self.accepted = self._load_columns(db, '''
+        SELECT opponent, variant, rating, accepted FROM user_urls
+        ''', [
+            lambda values: encode(values, opponent_codes),
+            lambda values: encode(values, variant_codes),
+            rating_column,
+            bool_column
+        ])
+
+        self.usernames = list(user_codes)
+        self.opponent_names = list(opponent_codes)
+        self.variant_names = list(variant_codes)
+
+    @staticmethod
+    def _load_columns(db, query, converters):
+        """Load the result of a query as an array per column.
+
+        Rows are fetched and converted in chunks of `LOAD_CHUNK_SIZE`,
+        so the whole result is never held as Python tuples at once.
+
+        Args:
+          db (Database): The open database.
+          query (str): The query to run.
+          converters (list): A function per column converting a tuple
+          of its values to an array.
+
+        Returns:
+          list: The array of each column.
+        """
+        cursor = db.conn.execute(query)
+        chunks = [[convert(()) for convert in converters]]
+
+        while True:
+            rows = cursor.fetchmany(LOAD_CHUNK_SIZE)
+            if not rows:
+                break
+            chunks.append([convert(values) for convert, values in zip(converters, zip(*rows))])
+
+        return [np.concatenate(columns) for columns in zip(*chunks)]
+
+    def acceptance_by_rating_band(self, band_width=RATING_BAND_WIDTH):
+        """Return the acceptance % of opportunities by user rating band.
+
+        Opportunities in games where the user's rating is unknown are
+        excluded.
+
+        Args:
+          band_width (int, optional): The width of the rating bands.
+          Defaults to `RATING_BAND_WIDTH`.
+
+        Returns:
+          list: A list of tuples, sorted by rating, containing:
+            - int: The lowest rating in the band.
+            - int: The number of opportunities.
+            - float: The percentage of opportunities accepted.
+        """
+        known = self.ratings != UNKNOWN_RATING
+        bands = self.ratings[known] // band_width
+
+        opportunities = np.bincount(bands)
+        accepted = np.bincount(bands, weights=self.accepted[known])
+        accepted_percentages = percentages(accepted, opportunities)
+
+        return [
+            (int(band) * band_width, int(opportunities[band]), float(accepted_percentages[band]))
+            for band in np.flatnonzero(opportunities)
+        ]
+
+    def acceptance_by_variant(self):
+        """Return the acceptance % of opportunities by chess variant.
+
+        Returns:
+          list: A list of tuples, sorted by opportunities, containing:
+            - str: The variant name, or `None` if unknown.
+            - int: The number of opportunities.
+            - float: The percentage of opportunities accepted.
+        """
+        opportunities = np.bincount(self.variants, minlength=len(self.variant_names))
+        accepted = np.bincount(
+            self.variants, weights=self.accepted, minlength=len(self.variant_names)
+        )
+        accepted_percentages = percentages(accepted, opportunities)
+
+        return [
+            (self.variant_names[code], int(opportunities[code]), float(accepted_percentages[code]))
+            for code in np.argsort(-opportunities, kind='stable')
+        ]
+
+    def acceptance_by_opponent(self, min_opportunities=1, limit=None):
+        """Return the acceptance % of opportunities given by opponents.
+
+        Args:
+          min_opportunities (int, optional): The min opportunities an
+          opponent must have given. Defaults to 1.
+          limit (int, optional): The max number of opponents. Defaults
+          to `None`, which returns all.
+
+        Returns:
+          list: A list of tuples, sorted by opportunities, containing:
+            - str: The opponent's username.
+            - int: The number of opportunities given.
+            - float: The percentage of opportunities accepted.
+        """
+        opportunities = np.bincount(self.opponents, minlength=len(self.opponent_names))
+        accepted = np.bincount(
+            self.opponents, weights=self.accepted, minlength=len(self.opponent_names)
+        )
+        accepted_percentages = percentages(accepted, opportunities)
+
+        codes = np.flatnonzero(opportunities >= min_opportunities)
+        codes = codes[np.argsort(-opportunities[codes], kind='stable')][:limit]
+
+        return [
+            (self.opponent_names[code], int(opportunities[code]), float(accepted_percentages[code]))
+            for code in codes
+        ]
+
+    def declines_per_thousand_games(self, min_games=1, limit=None):
+        """Return users sorted by en passants declined per 1000 games.
+
+        Args:
+          min_games (int, optional): The min games a user must have
+          played. Defaults to 1.
+          limit (int, optional): The max number of users. Defaults to
+          `None`, which returns all.
+
+        Returns:
+          list: A list of tuples containing:
+            - str: The username.
+            - int: The total number of games.
+            - float: The number of declines per 1000 games.
+        """
+        codes = np.flatnonzero(self.games >= max(min_games, 1))
+        rates = self.declined_nos[codes] * 1000 / self.games[codes]
+        order = np.argsort(-rates, kind='stable')[:limit]
+
+        return [
+            (self.usernames[codes[index]], int(self.games[codes[index]]), float(rates[index]))
+            for index in order
+        ]
+
+
+# Cached snapshots and their load times per database
+_snapshots = {}
+# Databases whose snapshot is being loaded
+_refreshing = set()
+_snapshots_changed = threading.Condition()
+
+
+def _refresh_snapshot(db_name):
+    """Load the snapshot of a database and replace the cached one."""
+    try:
+        db = Database(db_name)
+        try:
+            snapshot = StatsSnapshot(db)
+        finally:
+            db.close()
+
+        with _snapshots_changed:
+            _snapshots[db_name] = (time.monotonic(), snapshot)
+    finally:
+        with _snapshots_changed:
+            _refreshing.discard(db_name)
+            _snapshots_changed.notify_all()
+
+
+def get_snapshot(db_name):
+    """Return the snapshot of a database, reloading it if stale.
+
+    Stale snapshots are returned while one background thread reloads
+    them. Only the first load of a database is waited for.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+
+    Returns:
+      StatsSnapshot: The snapshot of the database.
+    """
+    with _snapshots_changed:
+        while True:
+            loaded_at, snapshot = _snapshots.get(db_name, (None, None))
+
+            if loaded_at is not None and time.monotonic() - loaded_at <= SNAPSHOT_TTL:
+                return snapshot
+
+            if db_name not in _refreshing:
+                _refreshing.add(db_name)
+                break
+
+            if snapshot is not None:
+                # Another thread is reloading the snapshot
+                return snapshot
+
+            # Wait for another thread's first load of the database
+            _snapshots_changed.wait()
+
+    if snapshot is not None:
+        threading.Thread(target=_refresh_snapshot, args=(db_name,), daemon=True).start()
+        return snapshot
+
+    _refresh_snapshot(db_name)
+
+    with _snapshots_changed:
+        return _snapshots[db_name][1]
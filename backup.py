@@ -0,0 +1,183 @@
+"""
+backup.py
+
+This module exports the statistics database to, and imports it from,
+gzip-compressed NDJSON, so that replicas can be seeded and backups
+restored without copying the SQLite file or re-querying Lichess.
+
+The file starts with a line identifying the format and schema version,
+followed by each table as a line naming its columns and one line per
+row holding a JSON array of values:
+
+    {"format": "en_passant_stats", "schemaVersion": 3}
+    {"table": "users", "columns": ["username", "ratedGames", "casualGames"]}
+    ["Bob", 1200, 30]
+    ...
+
+Rows are streamed in both directions, so memory use does not grow with
+the size of the database. Imports load every table in a single
+transaction, creating secondary indexes and derived tables after the
+rows are inserted.
+
+Functions:
+    export_database: Export the tables of a database to a file.
+    import_database: Import the tables of a file into an empty database.
+"""
+
+
+import gzip
+import json
+
+from database_manager import Database, SCHEMA_VERSION
+
+
+# Identifies files written by `export_database`
+FORMAT_NAME = 'en_passant_stats'
+# Tables exported, excluding analyses in progress and derived tables
+# which are rebuilt on import
+TABLES = [
+    'users', 'user_stats', 'user_urls', 'opportunities',
+    'filter_stats', 'filter_urls', 'game_costs'
+]
+# Rows parsed and inserted at a time during imports
+IMPORT_BATCH_SIZE = 10000
+# Gzip compression level, trading a slightly larger file for speed
+COMPRESS_LEVEL = 6
+
+# Encodes rows without spaces after separators
+_row_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+def export_database(db_name, path):
+    """Export the tables of a database to a compressed NDJSON file.
+
+    Tables are read in one transaction, so the export is a consistent
+    snapshot even while the app is writing to the database.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      path (str): The path of the file to write.
+
+    Returns:
+      dict: Table names mapped to the number of rows exported.
+    """
+    db = Database(db_name)
+    row_counts = {}
+
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=COMPRESS_LEVEL) as file:
+        file.write(json.dumps({'format': FORMAT_NAME, 'schemaVersion': SCHEMA_VERSION}) + '\n')
+
+        db.conn.execute('BEGIN')
+        for table in TABLES:
+            cursor = db.conn.execute(f'SELECT * FROM {table}')
+            columns = [column[0] for column in cursor.description]
+            file.write(json.dumps({'table': table, 'columns': columns}) + '\n')
+
+            row_counts[table] = 0
+            for row in cursor:
+                file.write(_row_encoder.encode(row) + '\n')
+                row_counts[table] += 1
+        db.conn.rollback()
+
+    db.close()
+    return row_counts
+
+
+def import_database(db_name, path):
+    """Import the tables of a compressed NDJSON file into a database.
+
+    All rows are inserted in a single transaction with secondary
+    indexes dropped, which are recreated once the rows are loaded.
+    If anything fails, the database is left unchanged.
+
+    Args:
+      db_name (str): The name of the SQLite database file, which is
+      created if it does not exist.
+      path (str): The path of a file written by `export_database`.
+
+    Returns:
+      dict: Table names mapped to the number of rows imported.
+
+    Raises:
+      ValueError: If the file is not an export of the current schema
+      version, or the database already has statistics.
+    """
+    db = Database(db_name)
+    row_counts = {}
+
+    try:
+        for table in TABLES:
+            if db.conn.execute(f'SELECT 1 FROM {table} LIMIT 1').fetchone():
+                raise ValueError(f"Database '{db_name}' already has rows in {table}!")
+
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            header = json.loads(file.readline() or 'null')
+            if not isinstance(header, dict) or header.get('format') != FORMAT_NAME:
+                raise ValueError(f"'{path}' is not an En Passant Analyser export!")
+            if header['schemaVersion'] != SCHEMA_VERSION:
+                raise ValueError(
+                    f"'{path}' has schema version {header['schemaVersion']}, "
+                    f'expected {SCHEMA_VERSION}!'
+                )
+
+            db.conn.execute('BEGIN IMMEDIATE')
+            db.drop_indexes()
+
+            query = None
+            batch = []
+
+            def insert_batch():
+                """Helper function to parse and insert the batch of rows."""
+                # Parsing the batch as one JSON array is faster than per row
+                rows = json.loads('[' + ','.join(batch) + ']')
+                db.conn.executemany(query, rows)
+                row_counts[table] += len(rows)
+                batch.clear()
+
+            for line in file:
+                # Rows are JSON arrays, table headers JSON objects
+                if line.startswith('['):
+                    if query is None:
+                        raise ValueError(f"'{path}' has rows before a table header!")
+                    batch.append(line)
+                    if len(batch) == IMPORT_BATCH_SIZE:
+                        insert_batch()
+                    continue
+
+                if batch:
+                    insert_batch()
+
+                # Start of the next table
+                table_header = json.loads(line)
+                table = table_header.get('table')
+                columns = table_header.get('columns', [])
+
+                if table not in TABLES:
+                    raise ValueError(f"'{path}' has unknown table {table}!")
+
+                table_columns = [
+                    row[1] for row in db.conn.execute(f'PRAGMA table_info({table})')
+                ]
+                if not columns or not set(columns) <= set(table_columns):
+                    raise ValueError(f"'{path}' has unknown columns in {table}!")
+
+                query = (
+                    f"INSERT INTO {table} ({', '.join(columns)}) "
+                    f"VALUES ({', '.join('?' * len(columns))})"
+                )
+                row_counts[table] = 0
+
+            if batch:
+                insert_batch()
+
+            db.rebuild_allowed_stats()
+            db.create_indexes()
+            db.conn.commit()
+    except BaseException:
+        db.conn.rollback()
+        raise
+    finally:
+        db.close()
+
+    return row_counts
+
@@ -0,0 +1,230 @@
+"""
+benchmark_analytics.py
+
+Benchmark of the columnar aggregations in `analytics` against the
+equivalent SQL GROUP BY queries run on every request.
+
+Fills a temporary database with synthetic users and en passant
+opportunities, checks both approaches give the same results, then
+reports the time per request of each aggregation and the one-off
+time to load the snapshot.
+
+Usage:
+    python benchmark_analytics.py [--users 100000] [--opportunities 1000000]
+"""
+
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from analytics import StatsSnapshot, RATING_BAND_WIDTH
+from database_manager import Database
+
+
+VARIANTS = ['Standard', 'Chess960', 'Crazyhouse', 'Atomic', 'Horde', 'Three-check']
+# Rows returned by the opponent and declines aggregations
+LIMIT = 50
+# Column each limited aggregation is sorted by, descending
+SORT_COLUMNS = {'opponents': 1, 'declineRates': 2}
+
+SQL_QUERIES = {
+    'ratingBands': (f'''
+        SELECT (rating / {RATING_BAND_WIDTH}) * {RATING_BAND_WIDTH} AS band,
+        COUNT(*),
+        AVG(accepted) * 100
+        FROM user_urls
+        WHERE rating IS NOT NULL
+        GROUP BY band
+        ORDER BY band
+    ''', ()),
+    'variants': ('''
+        SELECT variant, COUNT(*) AS opportunities, AVG(accepted) * 100
+        FROM user_urls
+        GROUP BY variant
+        ORDER BY opportunities DESC
+    ''', ()),
+    'opponents': ('''
+        SELECT opponent, COUNT(*) AS opportunities, AVG(accepted) * 100
+        FROM user_urls
+        GROUP BY opponent
+        ORDER BY opportunities DESC
+        LIMIT ?
+    ''', (LIMIT,)),
+    'declineRates': ('''
+        SELECT u.username,
+        (u.ratedGames + u.casualGames) AS totalGames,
+        SUM(s.declinedNo) * 1000.0 / (u.ratedGames + u.casualGames) AS declineRate
+        FROM users u
+        JOIN user_stats s ON u.username = s.username
+        GROUP BY u.username
+        HAVING totalGames > 0
+        ORDER BY declineRate DESC
+        LIMIT ?
+    ''', (LIMIT,))
+}
+
+SNAPSHOT_AGGREGATIONS = {
+    'ratingBands': lambda snapshot: snapshot.acceptance_by_rating_band(),
+    'variants': lambda snapshot: snapshot.acceptance_by_variant(),
+    'opponents': lambda snapshot: snapshot.acceptance_by_opponent(limit=LIMIT),
+    'declineRates': lambda snapshot: snapshot.declines_per_thousand_games(limit=LIMIT)
+}
+
+
+def fill_database(db, num_users, num_opportunities, seed=0):
+    """Insert synthetic users, stats and opportunities into a database.
+
+    Args:
+      db (Database): The open database.
+      num_users (int): The number of users to insert.
+      num_opportunities (int): The number of opportunities to insert.
+      seed (int, optional): The random seed. Defaults to 0.
+    """
+    rng = random.Random(seed)
+    usernames = [f'user{user_num}' for user_num in range(num_users)]
+
+    db.conn.executemany(
+        'INSERT INTO users (username, ratedGames, casualGames) VALUES (?, ?, ?)',
+        ((username, rng.randint(0, 5000), rng.randint(0, 500)) for username in usernames)
+    )
+
+    accepted_nos = {}
+    opportunities = []
+    for url_num in range(num_opportunities):
+        username = rng.choice(usernames)
+        game_type = 'rated' if rng.random() < 0.8 else 'casual'
+        accepted = rng.random() < 0.6
+        counts = accepted_nos.setdefault((username, game_type), [0, 0])
+        counts[0 if accepted else 1] += 1
+
+        opportunities.append((
+            username,
+            # Opponents are mostly other users, with a long tail
+            rng.choice(usernames) if rng.random() < 0.9 else f'opponent{url_num}',
+            game_type,
+            accepted,
+            f'https://lichess.org/{url_num}',
+            rng.randint(600, 3000) if rng.random() < 0.95 else None,
+            rng.choices(VARIANTS, [90, 3, 2, 2, 1, 2])[0]
+        ))
+
+    db.conn.executemany('''
+    INSERT INTO user_urls (username, opponent, gameType, accepted, url, rating, variant)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', opportunities)
+    db.conn.executemany(
+        'INSERT INTO user_stats (username, gameType, acceptedNo, declinedNo) VALUES (?, ?, ?, ?)',
+        ((username, game_type, accepted, declined)
+         for (username, game_type), (accepted, declined) in accepted_nos.items())
+    )
+    db.conn.commit()
+
+
+def time_per_call(func, repeats):
+    """Return the average seconds taken by `func()` over repeats."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        func()
+    return (time.perf_counter() - start) / repeats
+
+
+def check_results(name, sql_rows, snapshot_rows):
+    """Check SQL and snapshot aggregation results agree.
+
+    Ties in the sort order may be broken differently, so rows are
+    compared as sets of rounded values. Limited aggregations may also
+    cut off different rows tied with the last row, so only the rows
+    sorted before it must match.
+    """
+    def normalise(rows):
+        return [tuple(round(value, 6) if isinstance(value, float) else value
+                      for value in row) for row in rows]
+
+    sql_rows = normalise(sql_rows)
+    snapshot_rows = normalise(snapshot_rows)
+
+    if set(sql_rows) == set(snapshot_rows):
+        return
+
+    sort_column = SORT_COLUMNS.get(name)
+    if sort_column is None or len(sql_rows) != len(snapshot_rows) or len(sql_rows) < LIMIT:
+        raise AssertionError(f'{name}: SQL and snapshot results differ!')
+
+    cutoff = sql_rows[-1][sort_column]
+    if snapshot_rows[-1][sort_column] != cutoff:
+        raise AssertionError(f'{name}: SQL and snapshot results differ at the cut-off!')
+
+    def before_cutoff(rows):
+        return {row for row in rows if row[sort_column] != cutoff}
+
+    if before_cutoff(sql_rows) != before_cutoff(snapshot_rows):
+        raise AssertionError(f'{name}: SQL and snapshot results differ before the cut-off!')
+
+
+def main():
+    """Run the benchmark and print a report."""
+    parser = argparse.ArgumentParser(description='Benchmark columnar against SQL aggregations.')
+    parser.add_argument('--users', type=int, default=100000, help='The number of users.')
+    parser.add_argument(
+        '--opportunities', type=int, default=1000000, help='The number of opportunities.'
+    )
+    parser.add_argument(
+        '--repeats', type=int, default=5, help='The number of requests timed per aggregation.'
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db = Database(os.path.join(temp_dir, 'benchmark.db'))
+
+        start = time.perf_counter()
+        fill_database(db, args.users, args.opportunities)
+        print(
+            f'Filled database with {args.users} users and {args.opportunities} '
+            f'opportunities in {time.perf_counter() - start:.1f} seconds'
+        )
+
+        start = time.perf_counter()
+        snapshot = StatsSnapshot(db)
+        load_time = time.perf_counter() - start
+        print(f'Loaded snapshot in {load_time * 1000:.1f} ms\n')
+
+        print(f"{'Aggregation':<14}{'SQL ms':>10}{'Snapshot ms':>14}{'Speedup':>10}")
+        total_sql_time = 0
+        total_snapshot_time = 0
+
+        for name, (query, params) in SQL_QUERIES.items():
+            sql_rows = db.conn.execute(query, params).fetchall()
+            check_results(name, sql_rows, SNAPSHOT_AGGREGATIONS[name](snapshot))
+
+            sql_time = time_per_call(
+                lambda: db.conn.execute(query, params).fetchall(), args.repeats
+            )
+            snapshot_time = time_per_call(
+                lambda: SNAPSHOT_AGGREGATIONS[name](snapshot), args.repeats
+            )
+            total_sql_time += sql_time
+            total_snapshot_time += snapshot_time
+
+            print(
+                f'{name:<14}{sql_time * 1000:>10.1f}{snapshot_time * 1000:>14.1f}'
+                f'{sql_time / snapshot_time:>9.1f}x'
+            )
+
+        print(
+            f"{'all':<14}{total_sql_time * 1000:>10.1f}{total_snapshot_time * 1000:>14.1f}"
+            f'{total_sql_time / total_snapshot_time:>9.1f}x'
+        )
+        print(
+            f'\nSnapshot load pays for itself after '
+            f'{load_time / max(total_sql_time - total_snapshot_time, 1e-9):.1f} '
+            f'statistics page requests'
+        )
+
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+benchmark_startup.py
+
+Benchmark of the cold start of the En Passant Analyser web app.
+
+Starts `main.py --serve` against a fresh temporary database several
+times and reports the time from launching the process to the first
+successful response of each route, along with the heavy modules
+loaded just by importing `main`.
+
+Usage:
+    python benchmark_startup.py [--repeats 5]
+"""
+
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+from load_test import get_free_port
+
+
+# Routes timed to their first successful response
+ROUTES = ['/', '/leaderboards']
+# Modules that only analyses or the statistics page should need
+HEAVY_MODULES = ['chess', 'chess.pgn', 'requests', 'numpy', 'waitress']
+# Seconds to wait for the app to start accepting connections
+STARTUP_TIMEOUT = 30
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+
+
+def get_imported_heavy_modules():
+    """Return the heavy modules loaded by importing `main`."""
+    code = (
+        'import sys; import main; '
+        f'print(",".join(name for name in {HEAVY_MODULES!r} if name in sys.modules))'
+    )
+    output = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=os.path.dirname(APP_PATH),
+        capture_output=True,
+        text=True,
+        check=True
+    ).stdout.strip()
+    return output.split(',') if output else []
+
+
+def time_first_response(route, timeout):
+    """Return the seconds from launching the app to a 200 for `route`.
+
+    Args:
+      route (str): The path of the route to request.
+      timeout (float): The seconds to wait for the app to respond.
+
+    Returns:
+      float: The seconds until the first successful response.
+    """
+    port = get_free_port()
+    url = f'http://localhost:{port}{route}'
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        start = time.perf_counter()
+        app = subprocess.Popen(
+            [sys.executable, APP_PATH, '--serve', '--port', str(port), '--db', 'startup.db'],
+            cwd=temp_dir,
+            stdout=subprocess.DEVNULL
+        )
+
+        try:
+            while time.perf_counter() - start < timeout:
+                try:
+                    if requests.get(url, timeout=1).status_code == 200:
+                        return time.perf_counter() - start
+                except requests.ConnectionError:
+                    pass
+                time.sleep(0.005)
+        finally:
+            app.terminate()
+            app.wait()
+
+    raise RuntimeError(f'{route} did not respond within {timeout} seconds!')
+
+
+def main():
+    """Run the benchmark and print a report."""
+    parser = argparse.ArgumentParser(description='Benchmark cold start of the web app.')
+    parser.add_argument(
+        '--repeats', type=int, default=5, help='The number of cold starts timed per route.'
+    )
+    args = parser.parse_args()
+
+    heavy_modules = get_imported_heavy_modules()
+    print(f"Heavy modules loaded by 'import main': {', '.join(heavy_modules) or 'none'}\n")
+
+    print(f"{'Route':<16}{'Min ms':>10}{'Median ms':>12}")
+    for route in ROUTES:
+        times = [time_first_response(route, STARTUP_TIMEOUT) for _ in range(args.repeats)]
+        print(f'{route:<16}{min(times) * 1000:>10.1f}{statistics.median(times) * 1000:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
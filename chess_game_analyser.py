@@ -1,208 +1,486 @@
-"""
-chess_game_analyser.py
-
-This module provides a `ChessGame` class for analyzing chess games
-using the python-chess library. It supports extracting metadata,
-analyzing moves, and identifying en passant opportunities.
-
-Classes:
-    ChessGame: A utility class for analyzing chess games and
-    extracting information.
-
-Key Technical Terms:
-    - En passant: A special pawn capture that can occur when a pawn
-      moves two squares forward from its starting position and lands
-      beside an opponent's pawn. Only on the next turn, the opponent
-      pawn has the opportunity to en passant, where the pawn can be
-      captured in passing as if it had only moved one square.
-    - Halfmove: A turn made by either white or black, since one move
-      consists of a turn by each player. 
-    - PGN (Portable Game Notation): A text-based format for recording
-      chess games, including moves and metadata.
-    - FEN (Forsyth-Edwards Notation): A standard notation for
-      describing a chessboard position. It consists of six fields
-      separated by spaces:
-        1. Piece placement
-        2. Active color (white or black to move)
-        3. Castling availability
-        4. En passant target square
-        5. Halfmove clock
-        6. Fullmove number
-"""
-
-
-from io import StringIO
-
-import chess
-import chess.pgn
-
-
-# Chess Variants
-HORDE_INITIAL_FEN = 'rnbqkbnr/pppppppp/8/1PP2PP1/PPPPPPPP/PPPPPPPP/PPPPPPPP/PPPPPPPP w kq - 0 1'
-RACING_KINGS_INITIAL_FEN = '8/8/8/8/8/8/krbnNBRK/qrbnNBRQ w - - 0 1'
-
-# 4th field of FEN is the en passant target square
-TARGET_SQUARE_FIELD = 4
-# 4th field of '-' in FEN means no en passant possible in position
-TARGET_SQUARE_EMPTY = '-'
-
-WHITE = 'white'
-BLACK = 'black'
-
-
-class ChessGame:
-    """Utility class for extracting information from a chess game."""
-    def __init__(self, pgn_string, username):
-        """Initialise the ChessGame object.
-
-        Args:
-          pgn_string (str): The PGN string representing the game.
-          username (str): The username of the player being analysed.
-
-        Raises:
-          ValueError: If the provided username is not a player in the
-          game.
-        """
-        self._pgn = pgn_string
-
-        # Convert the string into StringIO object and read the game
-        self._game = chess.pgn.read_game(StringIO(self._pgn))
-
-        # Get the game information
-        self._game_info = self._game.headers
-
-        if username == self.get_white_player():
-            self._opponent = self.get_black_player()
-        elif username == self.get_black_player():
-            self._opponent = self.get_white_player()
-        else:
-            raise ValueError(f'{username} is not a player in this game!')
-        # Externally get username we are processing stats for
-        self._user = username
-
-        # Create a virtual chessboard
-        self._board = chess.Board()
-
-        if 'FEN' in self._game_info:
-            # Set initial position based on FEN tag if it exists
-            # Accounts for Chess960 and From Position variants
-            self._initial_fen = self._game_info['FEN']
-        elif self.get_variant() == 'Horde':
-            # Horde variant has different initial position
-            self._initial_fen = HORDE_INITIAL_FEN
-        elif self.get_variant() == 'Racing Kings':
-            # Racing Kings variant has different initial position
-            self._initial_fen = RACING_KINGS_INITIAL_FEN
-        else:
-            # Standard chess starting position
-            self._initial_fen = chess.STARTING_FEN
-
-    def get_user(self):
-        """Return username of player being analysed."""
-        return self._user
-    
-    def get_opponent(self):
-        """Return opponent's username."""
-        return self._opponent
-
-    def get_event(self):
-        """Return event name of the game."""
-        return self._game_info['Event']
-
-    def get_url(self):
-        """Return base URL of the game."""
-        return self._game_info['Site']
-    
-    def get_date(self):
-        """Return date of the game."""
-        return self._game_info['Date']
-    
-    def get_white_player(self):
-        """Return username of white player."""
-        return self._game_info['White']
-    
-    def get_black_player(self):
-        """Return username of black player."""
-        return self._game_info['Black']
-    
-    def get_user_color(self):
-        """Return colour of user being analysed."""
-        return WHITE if self._user == self.get_white_player() else BLACK
-    
-    def get_result(self):
-        """Return result of the game."""
-        return self._game_info['Result']
-    
-    def get_winner(self):
-        """Return username of winner."""
-        result = self.get_result()
-
-        if result == '1-0':
-            return self.get_white_player()
-        elif result == '0-1':
-            return self.get_black_player()
-        else:
-            return 'Draw'
-    
-    def get_variant(self):
-        """Return name of chess variant."""
-        return self._game_info['Variant']
-    
-    def get_en_passant_urls(self):
-        """Get URLs for the en passant opportunities in the game.
-
-        Identifies all en passant opportunities in the game and
-        categorises them as 'accepted' or 'declined' based on whether
-        the user captured the pawn.
-
-        Returns:
-          dict: A dictionary with two keys:
-            - 'accepted': A set of URLs where en passant was accepted.
-            - 'declined': A set of URLS where en passant was declined.
-        """
-        en_passant_urls = {'accepted': set(), 'declined': set()}
-
-        game_url = self.get_url()
-        user_color = self.get_user_color()
-        # Appends colour to base game URL
-        # Determines which board perspective will load
-        url = f'{game_url}/{user_color}'
-
-        self._board.set_fen(self._initial_fen)
-        opportunity = False
-
-        for halfmove_num, move in enumerate(self._game.mainline_moves(), start=1):
-            if opportunity:
-                if self._board.is_en_passant(move):
-                    en_passant_urls['accepted'].add(move_url)
-                else:
-                    en_passant_urls['declined'].add(move_url)
-
-                opportunity = False
-            
-            try:
-                self._board.push(move)
-            except AssertionError:
-                # Handle variants not supported by 'chess' module ('Atomic')
-                break
-
-            fen = self._board.fen()
-            target_square = fen.split()[TARGET_SQUARE_FIELD - 1]
-
-            # En passant not possible
-            if target_square == TARGET_SQUARE_EMPTY:
-                continue
-
-            # En passant possible but for opponent
-            if user_color == WHITE and halfmove_num % 2 == 1:
-                continue
-            if user_color == BLACK and halfmove_num % 2 == 0:
-                continue
-
-            # User has opportunity to en passant on next halfmove
-            opportunity = True
-            # Appends the halfmove number to URL
-            # Loads the game at that position
-            move_url = f'{url}#{halfmove_num}'
-
-        return en_passant_urls
\ No newline at end of file
+"""
+chess_game_analyser.py
+
+This module provides a `ChessGame` class for analyzing chess games
+using the python-chess library. It supports extracting metadata,
+analyzing moves, and identifying en passant opportunities.
+
+Classes:
+    ChessGame: A utility class for analyzing chess games and
+    extracting information.
+
+Key Technical Terms:
+    - En passant: A special pawn capture that can occur when a pawn
+      moves two squares forward from its starting position and lands
+      beside an opponent's pawn. Only on the next turn, the opponent
+      pawn has the opportunity to en passant, where the pawn can be
+      captured in passing as if it had only moved one square.
+    - Halfmove: A turn made by either white or black, since one move
+      consists of a turn by each player. 
+    - PGN (Portable Game Notation): A text-based format for recording
+      chess games, including moves and metadata.
+    - FEN (Forsyth-Edwards Notation): A standard notation for
+      describing a chessboard position. It consists of six fields
+      separated by spaces:
+        1. Piece placement
+        2. Active color (white or black to move)
+        3. Castling availability
+        4. En passant target square
+        5. Halfmove clock
+        6. Fullmove number
+"""
+
+
+import re
+import threading
+from datetime import datetime, timezone
+from io import StringIO
+from time import perf_counter
+
+import chess
+import chess.pgn
+
+from lichess_api import VARIANT_PERF_TYPES, CORRESPONDENCE, get_speed
+
+
+# Chess Variants
+HORDE_INITIAL_FEN = 'rnbqkbnr/pppppppp/8/1PP2PP1/PPPPPPPP/PPPPPPPP/PPPPPPPP/PPPPPPPP w kq - 0 1'
+RACING_KINGS_INITIAL_FEN = '8/8/8/8/8/8/krbnNBRK/qrbnNBRQ w - - 0 1'
+
+# 4th field of FEN is the en passant target square
+TARGET_SQUARE_FIELD = 4
+# 4th field of '-' in FEN means no en passant possible in position
+TARGET_SQUARE_EMPTY = '-'
+
+WHITE = 'white'
+BLACK = 'black'
+
+# Variants where every pawn starts on its 2nd rank and can only reach
+# other squares by moving there, so the movetext alone can rule out
+# en passant (Horde starts with pawns further up, Crazyhouse drops them)
+PAWN_MOVES_ONLY_VARIANTS = {
+    'Standard', 'Antichess', 'Atomic', 'King of the Hill',
+    'Racing Kings', 'Three-check'
+}
+
+# Comments such as clock times, e.g. '{ [%clk 0:03:00] }'
+COMMENT_REGEX = re.compile(r'\{[^}]*\}')
+# Move numbers ('12.' or '12...'), NAGs and game results
+NON_MOVE_REGEX = re.compile(r'^(\d+\.+|\$\d+|1-0|0-1|1/2-1/2|\*)$')
+
+# Pawn moves (including captures) landing on the given rank
+WHITE_PAWN_TO_RANK_5 = re.compile(r'^[a-h](x[a-h])?5')
+BLACK_PAWN_TO_RANK_4 = re.compile(r'^[a-h](x[a-h])?4')
+# Non-capturing pawn moves to the rank reached by a double step
+WHITE_PAWN_PUSH_TO_RANK_4 = re.compile(r'^[a-h]4')
+BLACK_PAWN_PUSH_TO_RANK_5 = re.compile(r'^[a-h]5')
+
+# Chessboards are reused across games on the same thread (worker)
+_thread_local = threading.local()
+
+
+def get_board():
+    """Return the chessboard shared by all games analysed on this thread."""
+    board = getattr(_thread_local, 'board', None)
+
+    if board is None:
+        board = _thread_local.board = chess.Board()
+
+    return board
+
+
+def scan_pgn(pgn_string):
+    """Split a PGN string into its headers and movetext.
+
+    A lightweight alternative to `chess.pgn.read_game` which does not
+    decode any moves.
+
+    Args:
+      pgn_string (str): The PGN string representing the game.
+
+    Returns:
+      tuple: A tuple containing:
+        - dict: The header tag names mapped to their values.
+        - str: The movetext following the headers.
+    """
+    headers = {}
+    lines = pgn_string.strip().splitlines()
+
+    for line_num, line in enumerate(lines):
+        if not line.startswith('['):
+            return headers, '\n'.join(lines[line_num:])
+
+        tag_match = chess.pgn.TAG_REGEX.match(line)
+        if tag_match:
+            headers[tag_match.group(1)] = tag_match.group(2)
+
+    return headers, ''
+
+
+class _MainlineMovesVisitor(chess.pgn.BaseVisitor):
+    """PGN visitor collecting mainline moves without building a game tree."""
+    def begin_game(self):
+        self._moves = []
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        self._moves.append(move)
+
+    def handle_error(self, error):
+        # Like `chess.pgn.GameBuilder`, stop at the first illegal move
+        pass
+
+    def result(self):
+        return self._moves
+
+
+class ChessGame:
+    """Utility class for extracting information from a chess game."""
+    def __init__(self, pgn_string, username, lazy=False):
+        """Initialise the ChessGame object.
+
+        Args:
+          pgn_string (str): The PGN string representing the game.
+          username (str): The username of the player being analysed.
+          lazy (bool, optional): Whether to only scan the headers and
+          defer decoding moves until they are needed. Defaults to
+          `False`, which reads the full game tree upfront.
+
+        Raises:
+          ValueError: If the provided username is not a player in the
+          game.
+        """
+        self._pgn = pgn_string
+        self._lazy = lazy
+
+        if lazy:
+            # Scan the headers and keep the movetext undecoded
+            self._game = None
+            self._game_info, self._movetext = scan_pgn(self._pgn)
+        else:
+            # Convert the string into StringIO object and read the game
+            self._game = chess.pgn.read_game(StringIO(self._pgn))
+
+            # Get the game information
+            self._game_info = self._game.headers
+
+        if username == self.get_white_player():
+            self._opponent = self.get_black_player()
+        elif username == self.get_black_player():
+            self._opponent = self.get_white_player()
+        else:
+            raise ValueError(f'{username} is not a player in this game!')
+        # Externally get username we are processing stats for
+        self._user = username
+
+        if 'FEN' in self._game_info:
+            # Set initial position based on FEN tag if it exists
+            # Accounts for Chess960 and From Position variants
+            self._initial_fen = self._game_info['FEN']
+        elif self.get_variant() == 'Horde':
+            # Horde variant has different initial position
+            self._initial_fen = HORDE_INITIAL_FEN
+        elif self.get_variant() == 'Racing Kings':
+            # Racing Kings variant has different initial position
+            self._initial_fen = RACING_KINGS_INITIAL_FEN
+        else:
+            # Standard chess starting position
+            self._initial_fen = chess.STARTING_FEN
+
+        # Cost of the last en passant analysis
+        self._halfmoves_replayed = 0
+        self._analysis_time = 0.0
+        self._analysis_aborted = False
+
+    def get_user(self):
+        """Return username of player being analysed."""
+        return self._user
+    
+    def get_opponent(self):
+        """Return opponent's username."""
+        return self._opponent
+
+    def get_event(self):
+        """Return event name of the game."""
+        return self._game_info['Event']
+
+    def get_url(self):
+        """Return base URL of the game."""
+        return self._game_info['Site']
+    
+    def get_date(self):
+        """Return date of the game."""
+        return self._game_info['Date']
+    
+    def get_white_player(self):
+        """Return username of white player."""
+        return self._game_info['White']
+    
+    def get_black_player(self):
+        """Return username of black player."""
+        return self._game_info['Black']
+    
+    def get_user_rating(self):
+        """Return rating of user being analysed, or `None` if unknown."""
+        tag = 'WhiteElo' if self.get_user_color() == WHITE else 'BlackElo'
+        rating = self._game_info.get(tag, '?')
+        return int(rating) if rating.isdigit() else None
+
+    def get_user_color(self):
+        """Return colour of user being analysed."""
+        return WHITE if self._user == self.get_white_player() else BLACK
+    
+    def get_result(self):
+        """Return result of the game."""
+        return self._game_info['Result']
+    
+    def get_winner(self):
+        """Return username of winner."""
+        result = self.get_result()
+
+        if result == '1-0':
+            return self.get_white_player()
+        elif result == '0-1':
+            return self.get_black_player()
+        else:
+            return 'Draw'
+    
+    def get_variant(self):
+        """Return name of chess variant."""
+        return self._game_info['Variant']
+    
+    def may_have_en_passant(self, color=None):
+        """Cheaply check whether a player could have an en passant.
+
+        Scans the movetext without decoding it. For a player to en
+        passant, one of their pawns must have reached their 5th rank
+        before an opponent pawn is pushed beside it. If the game starts
+        from the standard pawn structure and no such pawn moves are
+        played, there can be no opportunity.
+
+        Args:
+          color (str, optional): The colour of the player ('white' or
+          'black'). Defaults to `None`, which checks the user.
+
+        Returns:
+          bool: False if an opportunity is impossible, True otherwise.
+        """
+        if 'FEN' in self._game_info:
+            return True
+        if self._game_info.get('Variant', 'Standard') not in PAWN_MOVES_ONLY_VARIANTS:
+            return True
+
+        if self._lazy:
+            movetext = self._movetext
+        else:
+            movetext = self._game.accept(chess.pgn.StringExporter(
+                headers=False, comments=False, variations=False
+            ))
+
+        movetext = COMMENT_REGEX.sub(' ', movetext)
+        if '(' in movetext:
+            # Variations would break alternation of white and black moves
+            return True
+
+        sans = [token for token in movetext.split() if not NON_MOVE_REGEX.match(token)]
+
+        if (color or self.get_user_color()) == WHITE:
+            player_sans, opponent_sans = sans[0::2], sans[1::2]
+            player_regex, opponent_regex = WHITE_PAWN_TO_RANK_5, BLACK_PAWN_PUSH_TO_RANK_5
+            # Black moves second, so its nth move follows white's nth
+            offset = 0
+        else:
+            player_sans, opponent_sans = sans[1::2], sans[0::2]
+            player_regex, opponent_regex = BLACK_PAWN_TO_RANK_4, WHITE_PAWN_PUSH_TO_RANK_4
+            # White's (n + 1)th move follows black's nth
+            offset = 1
+
+        for player_num, san in enumerate(player_sans):
+            if player_regex.match(san):
+                return any(
+                    opponent_regex.match(san)
+                    for san in opponent_sans[player_num + offset:]
+                )
+
+        return False
+
+    def get_mainline_moves(self):
+        """Return the moves of the game's mainline.
+
+        In lazy mode, the movetext is decoded on every call.
+        """
+        if self._lazy:
+            return chess.pgn.read_game(
+                StringIO(self._pgn), Visitor=_MainlineMovesVisitor
+            ) or []
+        return self._game.mainline_moves()
+
+    def get_time_control(self):
+        """Return time control of the game, e.g. '180+2' or '-'."""
+        return self._game_info.get('TimeControl', '-')
+
+    def get_perf_type(self):
+        """Return Lichess performance type of the game, e.g. 'blitz'."""
+        variant = self._game_info.get('Variant', 'Standard')
+
+        if variant in VARIANT_PERF_TYPES:
+            return VARIANT_PERF_TYPES[variant]
+
+        time_control = self.get_time_control()
+
+        # Correspondence games have no clock
+        if '+' not in time_control:
+            return CORRESPONDENCE
+
+        return get_speed(time_control)
+
+    def get_timestamp(self):
+        """Return start time of the game in milliseconds since epoch."""
+        date = self._game_info.get('UTCDate', self._game_info.get('Date'))
+        time = self._game_info.get('UTCTime', '00:00:00')
+
+        start = datetime.strptime(f'{date} {time}', '%Y.%m.%d %H:%M:%S')
+        return int(start.replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+    def matches_filters(self, filters):
+        """Check whether the game matches the given game filters.
+
+        Args:
+          filters (dict): Filters with any of the keys:
+            - 'perfType' (str): The Lichess performance type.
+            - 'color' (str): The colour of the user.
+            - 'since' (int): The earliest start time in milliseconds.
+            - 'until' (int): The latest start time in milliseconds.
+
+        Returns:
+          bool: True if the game matches all filters, False otherwise.
+        """
+        if 'perfType' in filters and self.get_perf_type() != filters['perfType']:
+            return False
+        if 'color' in filters and self.get_user_color() != filters['color']:
+            return False
+        if 'since' in filters or 'until' in filters:
+            timestamp = self.get_timestamp()
+            if timestamp < filters.get('since', timestamp):
+                return False
+            if timestamp > filters.get('until', timestamp):
+                return False
+        return True
+
+    def get_analysis_cost(self):
+        """Return the cost of the last call to `get_en_passant_urls`.
+
+        Returns:
+          dict: A dictionary with keys:
+            - 'variant' (str): The name of the chess variant.
+            - 'halfmoves' (int): The number of halfmoves replayed.
+            - 'seconds' (float): The time taken to analyse the game.
+            - 'aborted' (bool): Whether the replay stopped early on a
+              move unsupported by the 'chess' module.
+        """
+        return {
+            'variant': self._game_info.get('Variant', 'Standard'),
+            'halfmoves': self._halfmoves_replayed,
+            'seconds': self._analysis_time,
+            'aborted': self._analysis_aborted
+        }
+
+    def get_en_passant_urls(self):
+        """Get URLs for the en passant opportunities in the game.
+
+        Identifies all en passant opportunities of the user in the game
+        and categorises them as 'accepted' or 'declined' based on
+        whether the user captured the pawn. The cost of the analysis is
+        recorded for `get_analysis_cost`.
+
+        Returns:
+          dict: A dictionary with two keys:
+            - 'accepted': A set of URLs where en passant was accepted.
+            - 'declined': A set of URLS where en passant was declined.
+        """
+        en_passant_urls = {'accepted': set(), 'declined': set()}
+
+        for player, _, url, accepted in self.get_en_passant_opportunities():
+            if player == self._user:
+                en_passant_urls['accepted' if accepted else 'declined'].add(url)
+
+        return en_passant_urls
+
+    def get_en_passant_opportunities(self):
+        """Get the en passant opportunities of both players in the game.
+
+        The cost of the analysis is recorded for `get_analysis_cost`.
+
+        Returns:
+          list: A list of tuples, in order of play, containing:
+            - str: The username of the player with the opportunity.
+            - str: The username of the player who allowed it by
+              pushing a pawn two squares.
+            - str: The URL of the position, from the perspective of
+              the player with the opportunity.
+            - bool: Whether the player captured en passant.
+        """
+        start_time = perf_counter()
+        self._halfmoves_replayed = 0
+        self._analysis_aborted = False
+
+        opportunities = self._find_en_passant_opportunities()
+
+        self._analysis_time = perf_counter() - start_time
+        return opportunities
+
+    def _find_en_passant_opportunities(self):
+        """Replay the game to find en passant opportunities."""
+        opportunities = []
+
+        # Skip decoding moves entirely if no opportunity is possible
+        if self._lazy and not any(
+            self.may_have_en_passant(color) for color in [WHITE, BLACK]
+        ):
+            return opportunities
+
+        game_url = self.get_url()
+        players = {WHITE: self.get_white_player(), BLACK: self.get_black_player()}
+
+        board = get_board()
+        board.set_fen(self._initial_fen)
+        # Player with an opportunity to en passant on this halfmove
+        opportunity_color = None
+
+        for halfmove_num, move in enumerate(self.get_mainline_moves(), start=1):
+            if opportunity_color is not None:
+                opponent_color = BLACK if opportunity_color == WHITE else WHITE
+                opportunities.append((
+                    players[opportunity_color],
+                    players[opponent_color],
+                    move_url,
+                    board.is_en_passant(move)
+                ))
+
+                opportunity_color = None
+
+            try:
+                board.push(move)
+            except AssertionError:
+                # Handle variants not supported by 'chess' module ('Atomic')
+                self._analysis_aborted = True
+                break
+
+            self._halfmoves_replayed = halfmove_num
+
+            fen = board.fen()
+            target_square = fen.split()[TARGET_SQUARE_FIELD - 1]
+
+            # En passant not possible
+            if target_square == TARGET_SQUARE_EMPTY:
+                continue
+
+            # Player to move next has opportunity to en passant
+            opportunity_color = WHITE if board.turn == chess.WHITE else BLACK
+            # Appends colour to base game URL to load their perspective
+            # and the halfmove number to load the game at that position
+            move_url = f'{game_url}/{opportunity_color}#{halfmove_num}'
+
+        return opportunities
@@ -1,214 +1,694 @@
-import sqlite3
-
-
-class Database:
-    """Utility class for managing database CRUD."""
-    def __init__(self, db_name='en_passant_stats.db'):
-        """Initialise the database connection.
-
-        Additionally, creates tables if they do not exist.
-
-        Args:
-          db_name (str): The name of the SQLite database file.
-          Defaults to 'en_passant_stats.db'.
-        """
-        self.conn = sqlite3.connect(db_name)
-        self.create_tables()
-
-    def create_tables(self):
-        """Create the neccessary tables if they do not already exist."""
-        # Create users table
-        self.conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            username TEXT PRIMARY KEY,
-            ratedGames INT,
-            casualGames INT
-        )           
-        ''')
-
-        # Create user_stats table
-        self.conn.execute('''
-        CREATE TABLE IF NOT EXISTS user_stats (
-            username TEXT,
-            gameType TEXT,
-            acceptedNo INT,
-            declinedNo INT,
-            FOREIGN KEY (username) REFERENCES users(username),
-            PRIMARY KEY (username, gameType)
-        )           
-        ''')
-
-        # Create user_urls table
-        self.conn.execute('''
-        CREATE TABLE IF NOT EXISTS user_urls (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT,
-            opponent TEXT,
-            gameType TEXT,
-            accepted BOOLEAN,
-            url TEXT UNIQUE,
-            FOREIGN KEY (username) REFERENCES users(username)
-        )           
-        ''')
-
-        self.conn.commit()
-
-    def update_num_games(self, username, rated_games, casual_games):
-        """Update user's total number of rated and casual games.
-
-        Inserts new entry into database if user does not exist.
-
-        Args:
-          username (str): The username of the user.
-          rated_games (int): The total number of rated games.
-          casual_games (int): The total number of casual games.
-        """
-        self.conn.execute('''
-        INSERT OR REPLACE INTO users (username, ratedGames, casualGames)
-        VALUES (?, ?, ?)
-        ''', (username, rated_games, casual_games))
-        self.conn.commit()
-
-    def update_stats(self, username, game_type, accepted_no, declined_no):
-        """Update user's en passant statistics.
-
-        Inserts entries into database if user does not exist.
-
-        Args:
-          username (str): The username of the user.
-          game_type (str): The type of game ('rated' or 'casual').
-          accepted_no (int): The number of en passants accepted.
-          declined_no (int): The number of en passants declined.
-        """
-        self.conn.execute('''
-        INSERT OR REPLACE INTO user_stats (username, gameType, acceptedNo, declinedNo)
-        VALUES (?, ?, ?, ?)
-        ''', (username, game_type, accepted_no, declined_no))
-        self.conn.commit()
-
-    def insert_url(self, username, opponent, game_type, accepted, url):
-        """Insert a URL for an en passant opportunity into database.
-        
-        Args:
-          username (str): The username of the user.
-          opponent (str): The opponent's username.
-          game_type (str): The type of game ('rated' or 'casual').
-          accepted (bool): Whether the en passant opportunity was accepted.
-          url (str): The URL of the game.
-        """
-        self.conn.execute('''
-        INSERT INTO user_urls (username, opponent, gameType, accepted, url)
-        VALUES (?, ?, ?, ?, ?)
-        ON CONFLICT (url) DO NOTHING;
-        ''', (username, opponent, game_type, accepted, url))
-        self.conn.commit()
-
-    def get_num_games(self, username):
-        """Retrieve user's total number of rated and casual games.
-
-        Args:
-          username (str): The username of the user.
-
-        Returns:
-          tuple: A tuple containing:
-            - int: The total number of rated games.
-            - int: The total number of casual games.
-        """
-        cursor = self.conn.execute('''
-        SELECT ratedGames, casualGames FROM users WHERE username = ?
-        ''', (username,))
-        return cursor.fetchone()
-
-    def get_stats(self, username, game_type):
-        """Retrieve the en passant statistics for a user.
-
-        Args:
-          username (str): The username of the user.
-          game_type (str): The type of game ('rated' or 'casual').
-
-        Returns:
-          tuple: A tuple containing:
-            - int: The number of en passants accepted.
-            - int: The number of en passants declined.
-        """
-        cursor = self.conn.execute('''
-        SELECT acceptedNo, declinedNo FROM user_stats WHERE username = ? AND gameType = ?
-        ''', (username, game_type))
-        return cursor.fetchone()
-
-    def get_urls(self, username, game_type, accepted):
-        """Retrieve the URLs for en passant opportunities for a user.
-
-        Args:
-          username (str): The username of the user.
-          game_type (str): The type of game ('rated' or 'casual').
-          accepted (bool): Whether en passant was accepted.
-
-        Returns:
-          list: A list of tuples, where each tuple contains:
-            - str: The URL of the game.
-            - str: The opponent's username.
-        """
-        cursor = self.conn.execute('''
-        SELECT url, opponent FROM user_urls WHERE username = ? AND gameType = ? AND accepted = ?
-        ''', (username, game_type, accepted))
-        return cursor.fetchall()
-    
-    def user_exists(self, username):
-        """Check if a user exists in the database.
-
-        Args:
-          username (str): The username of the user.
-
-        Returns:
-          bool: True if the user exists, False otherwise.
-        """
-        cursor = self.conn.execute('''
-        SELECT 1 FROM users WHERE username = ?
-        ''', (username,))
-        return cursor.fetchone() is not None
-    
-    def get_percentage_leaderboard(self):
-        """Retrieve the leaderboard sorted by acceptance %.
-
-        Returns:
-          list: A list of tuples, where each tuple contains:
-            - str: The username.
-            - int: The total number of en passant opportunities.
-            - float: The percentage of en passant captures accepted.
-        """
-        cursor = self.conn.execute('''
-            SELECT u.username,
-            (SUM(s.acceptedNo) + SUM(s.declinedNo)) AS opportunities,
-            (CAST(SUM(s.acceptedNo) AS FLOAT) / (SUM(s.acceptedNo) + SUM(s.declinedNo))) * 100 AS acceptedPercentage
-            FROM user_stats s
-            JOIN users u ON s.username = u.username
-            GROUP BY u.username
-            HAVING opportunities > 0
-            ORDER BY acceptedPercentage;
-        ''')
-        return cursor.fetchall()
-
-    def get_declined_leaderboard(self):
-        """Retrieve the leaderboard sorted by the total declines.
-
-        Returns:
-          list: A list of tuples, where each tuple contains:
-            - str: The username.
-            - int: The total number of games played.
-            - int: The total number of en passant captures declined.
-        """
-        cursor = self.conn.execute('''
-            SELECT u.username,
-            (u.ratedGames + u.casualGames) AS totalGames,
-            SUM(s.declinedNo) AS totalDeclined
-            FROM users u
-            JOIN user_stats s ON u.username = s.username
-            GROUP BY u.username
-            ORDER BY totalDeclined DESC;
-        ''')
-        return cursor.fetchall()
-
-    def close(self):
-        """Close the database connection."""
+import sqlite3
+import time
+
+
+# Seconds to wait for another connection to release a lock on the database
+BUSY_TIMEOUT = 30
+# Version of the table definitions, bumped whenever `create_tables` changes
+SCHEMA_VERSION = 3
+
+# Databases whose schema this process has already checked
+_checked_databases = set()
+
+
+class Database:
+    """Utility class for managing database CRUD."""
+    def __init__(self, db_name='en_passant_stats.db'):
+        """Initialise the database connection.
+
+        Methods recording analysis results leave committing to the
+        caller, so that the results of a checkpoint are saved together.
+
+        Additionally, creates tables if they do not exist. The schema is
+        checked against `SCHEMA_VERSION` once per database per process,
+        so later connections skip straight to serving queries.
+
+        The database is opened in write-ahead logging mode so that
+        readers in other threads or processes are not blocked by a
+        writer, and connections wait for locks instead of failing.
+
+        Args:
+          db_name (str): The name of the SQLite database file.
+          Defaults to 'en_passant_stats.db'.
+        """
+        self.conn = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT)
+
+        if db_name not in _checked_databases:
+            self.check_schema()
+            _checked_databases.add(db_name)
+
+    def get_schema_version(self):
+        """Return the schema version of the database, or 0 if unversioned."""
+        table = self.conn.execute('''
+        SELECT name FROM sqlite_master
+        WHERE type = 'table' AND name = 'schema_version'
+        ''').fetchone()
+
+        if table is None:
+            return 0
+
+        row = self.conn.execute('SELECT version FROM schema_version').fetchone()
+        return row[0] if row else 0
+
+    def check_schema(self):
+        """Create or migrate tables if the schema version is out of date.
+
+        The version is re-read under a write lock before migrating, so
+        only one of several processes starting at once runs the DDL.
+        """
+        if self.get_schema_version() == SCHEMA_VERSION:
+            return
+
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('BEGIN IMMEDIATE')
+        if self.get_schema_version() == SCHEMA_VERSION:
+            self.conn.rollback()
+            return
+
+        self.create_tables()
+
+    def create_tables(self):
+        """Create the neccessary tables if they do not already exist."""
+        # Create users table
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            ratedGames INT,
+            casualGames INT
+        )           
+        ''')
+
+        # Create user_stats table
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            username TEXT,
+            gameType TEXT,
+            acceptedNo INT,
+            declinedNo INT,
+            lastGameAt INT,
+            FOREIGN KEY (username) REFERENCES users(username),
+            PRIMARY KEY (username, gameType)
+        )           
+        ''')
+
+        # Add column missing from user_stats tables created before it
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(user_stats)')]
+        if 'lastGameAt' not in columns:
+            self.conn.execute('ALTER TABLE user_stats ADD COLUMN lastGameAt INT')
+
+        # Create user_urls table
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_urls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT,
+            opponent TEXT,
+            gameType TEXT,
+            accepted BOOLEAN,
+            url TEXT UNIQUE,
+            rating INT,
+            variant TEXT,
+            FOREIGN KEY (username) REFERENCES users(username)
+        )           
+        ''')
+
+        # Add columns missing from user_urls tables created before them
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(user_urls)')]
+        for column, column_type in [('rating', 'INT'), ('variant', 'TEXT')]:
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE user_urls ADD COLUMN {column} {column_type}')
+
+        # Create filter_stats table for stats restricted by game filters
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS filter_stats (
+            username TEXT,
+            filterKey TEXT,
+            gameType TEXT,
+            gamesNo INT,
+            acceptedNo INT,
+            declinedNo INT,
+            lastGameAt INT,
+            PRIMARY KEY (username, filterKey, gameType)
+        )
+        ''')
+
+        # Create filter_urls table
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS filter_urls (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT,
+            filterKey TEXT,
+            opponent TEXT,
+            gameType TEXT,
+            accepted BOOLEAN,
+            url TEXT,
+            UNIQUE (filterKey, url)
+        )
+        ''')
+
+        # Create game_costs table of analysis costs per user and variant
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS game_costs (
+            username TEXT,
+            variant TEXT,
+            gamesNo INT,
+            halfmovesNo INT,
+            seconds REAL,
+            abortedNo INT,
+            maxSeconds REAL,
+            slowestUrl TEXT,
+            PRIMARY KEY (username, variant)
+        )
+        ''')
+
+        # Create jobs table of analyses in progress across workers
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            username TEXT PRIMARY KEY,
+            startedAt REAL
+        )
+        ''')
+
+        # Create opportunities table of en passant chances of both players
+        # in analysed games, indexed by who allowed them
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS opportunities (
+            url TEXT PRIMARY KEY,
+            player TEXT COLLATE NOCASE,
+            allowedBy TEXT COLLATE NOCASE,
+            gameType TEXT,
+            accepted BOOLEAN
+        )
+        ''')
+
+        # Create allowed_stats table of opportunities allowed per player
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS allowed_stats (
+            username TEXT PRIMARY KEY COLLATE NOCASE,
+            allowedNo INT,
+            acceptedNo INT
+        )
+        ''')
+
+        # Index opportunities stored before the opportunities table
+        self.conn.execute('''
+        INSERT OR IGNORE INTO opportunities (url, player, allowedBy, gameType, accepted)
+        SELECT url, username, opponent, gameType, accepted FROM user_urls
+        ''')
+        self.rebuild_allowed_stats()
+
+        self.create_indexes()
+
+        # Create schema_version table recording the table definitions
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INT
+        )
+        ''')
+        self.conn.execute('DELETE FROM schema_version')
+        self.conn.execute('INSERT INTO schema_version (version) VALUES (?)', (SCHEMA_VERSION,))
+
+        self.conn.commit()
+
+    def create_indexes(self):
+        """Create the secondary indexes if they do not already exist."""
+        self.conn.execute('''
+        CREATE INDEX IF NOT EXISTS opportunities_by_players
+        ON opportunities (player, allowedBy)
+        ''')
+        self.conn.execute('''
+        CREATE INDEX IF NOT EXISTS allowed_stats_by_allowed
+        ON allowed_stats (allowedNo DESC)
+        ''')
+
+    def drop_indexes(self):
+        """Drop the secondary indexes, e.g. to speed up bulk inserts.
+
+        Indexes backing primary keys and unique constraints are kept.
+        """
+        indexes = self.conn.execute('''
+        SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL
+        ''').fetchall()
+
+        for (index,) in indexes:
+            self.conn.execute(f'DROP INDEX {index}')
+
+    def rebuild_allowed_stats(self):
+        """Recount the opportunities allowed per player from scratch."""
+        self.conn.execute('DELETE FROM allowed_stats')
+        self.conn.execute('''
+        INSERT INTO allowed_stats (username, allowedNo, acceptedNo)
+        SELECT allowedBy, COUNT(*), SUM(accepted) FROM opportunities
+        GROUP BY allowedBy
+        ''')
+
+    def acquire_job(self, username, stale_after):
+        """Try to claim the analysis of a user for this worker.
+
+        Claims left by workers which crashed are taken over once older
+        than `stale_after` seconds.
+
+        Args:
+          username (str): The case-insensitive username.
+          stale_after (float): The age in seconds after which an
+          existing claim is considered abandoned.
+
+        Returns:
+          bool: True if the claim was acquired, False if another worker
+          is analysing the user.
+        """
+        now = time.time()
+        cursor = self.conn.execute('''
+        INSERT INTO jobs (username, startedAt) VALUES (?, ?)
+        ON CONFLICT (username) DO UPDATE SET startedAt = excluded.startedAt
+        WHERE startedAt < ?
+        ''', (username.lower(), now, now - stale_after))
+        self.conn.commit()
+        return cursor.rowcount == 1
+
+    def release_job(self, username):
+        """Release the claim on the analysis of a user.
+
+        Args:
+          username (str): The case-insensitive username.
+        """
+        self.conn.execute('''
+        DELETE FROM jobs WHERE username = ?
+        ''', (username.lower(),))
+        self.conn.commit()
+
+    def update_num_games(self, username, rated_games, casual_games):
+        """Update user's total number of rated and casual games.
+
+        Inserts new entry into database if user does not exist.
+
+        Args:
+          username (str): The username of the user.
+          rated_games (int): The total number of rated games.
+          casual_games (int): The total number of casual games.
+        """
+        self.conn.execute('''
+        INSERT OR REPLACE INTO users (username, ratedGames, casualGames)
+        VALUES (?, ?, ?)
+        ''', (username, rated_games, casual_games))
+
+    def update_stats(self, username, game_type, accepted_no, declined_no,
+                     last_game_at=None):
+        """Update user's en passant statistics.
+
+        Inserts entries into database if user does not exist.
+
+        Args:
+          username (str): The username of the user.
+          game_type (str): The type of game ('rated' or 'casual').
+          accepted_no (int): The number of en passants accepted.
+          declined_no (int): The number of en passants declined.
+          last_game_at (int, optional): The timestamp in milliseconds
+          of the latest game analysed. Defaults to `None` if unknown.
+        """
+        self.conn.execute('''
+        INSERT OR REPLACE INTO user_stats
+        (username, gameType, acceptedNo, declinedNo, lastGameAt)
+        VALUES (?, ?, ?, ?, ?)
+        ''', (username, game_type, accepted_no, declined_no, last_game_at))
+
+    def insert_url(self, username, opponent, game_type, accepted, url,
+                   rating=None, variant=None):
+        """Insert a URL for an en passant opportunity into database.
+        
+        Args:
+          username (str): The username of the user.
+          opponent (str): The opponent's username.
+          game_type (str): The type of game ('rated' or 'casual').
+          accepted (bool): Whether the en passant opportunity was accepted.
+          url (str): The URL of the game.
+          rating (int, optional): The user's rating in the game.
+          Defaults to `None`.
+          variant (str, optional): The chess variant of the game.
+          Defaults to `None`.
+        """
+        self.conn.execute('''
+        INSERT INTO user_urls (username, opponent, gameType, accepted, url, rating, variant)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (url) DO NOTHING;
+        ''', (username, opponent, game_type, accepted, url, rating, variant))
+
+    def insert_opportunity(self, player, allowed_by, game_type, accepted, url):
+        """Insert an en passant opportunity of either player into database.
+
+        Adds it to the opportunities allowed by `allowed_by` if new.
+
+        Args:
+          player (str): The username of the player with the opportunity.
+          allowed_by (str): The username of the player who allowed it.
+          game_type (str): The type of game ('rated' or 'casual').
+          accepted (bool): Whether the en passant opportunity was accepted.
+          url (str): The URL of the game at the opportunity.
+        """
+        cursor = self.conn.execute('''
+        INSERT INTO opportunities (url, player, allowedBy, gameType, accepted)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (url) DO NOTHING;
+        ''', (url, player, allowed_by, game_type, accepted))
+
+        if cursor.rowcount == 1:
+            self.conn.execute('''
+            INSERT INTO allowed_stats (username, allowedNo, acceptedNo)
+            VALUES (?, 1, ?)
+            ON CONFLICT (username) DO UPDATE SET
+                allowedNo = allowedNo + 1,
+                acceptedNo = acceptedNo + excluded.acceptedNo
+            ''', (allowed_by, int(accepted)))
+
+    def update_filter_stats(self, username, filter_key, game_type, games_no,
+                            accepted_no, declined_no, last_game_at):
+        """Update user's en passant statistics for a set of game filters.
+
+        Inserts entries into database if they do not exist.
+
+        Args:
+          username (str): The username of the user.
+          filter_key (str): The canonical key of the game filters.
+          game_type (str): The type of game ('rated' or 'casual').
+          games_no (int): The number of games matching the filters.
+          accepted_no (int): The number of en passants accepted.
+          declined_no (int): The number of en passants declined.
+          last_game_at (int): The timestamp in milliseconds of the
+          latest game analysed, or `None` if there are none.
+        """
+        self.conn.execute('''
+        INSERT OR REPLACE INTO filter_stats
+        (username, filterKey, gameType, gamesNo, acceptedNo, declinedNo, lastGameAt)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (username, filter_key, game_type, games_no, accepted_no, declined_no, last_game_at))
+
+    def insert_filter_url(self, username, filter_key, opponent, game_type, accepted, url):
+        """Insert a URL for an en passant opportunity matching filters.
+
+        Args:
+          username (str): The username of the user.
+          filter_key (str): The canonical key of the game filters.
+          opponent (str): The opponent's username.
+          game_type (str): The type of game ('rated' or 'casual').
+          accepted (bool): Whether the en passant opportunity was accepted.
+          url (str): The URL of the game.
+        """
+        self.conn.execute('''
+        INSERT INTO filter_urls (username, filterKey, opponent, gameType, accepted, url)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (filterKey, url) DO NOTHING;
+        ''', (username, filter_key, opponent, game_type, accepted, url))
+
+    def add_game_costs(self, username, variant, games_no, halfmoves_no, seconds,
+                       aborted_no, max_seconds, slowest_url):
+        """Add the cost of analysing games to a user's totals.
+
+        Inserts entry into database if it does not exist.
+
+        Args:
+          username (str): The username of the user.
+          variant (str): The name of the chess variant.
+          games_no (int): The number of games analysed.
+          halfmoves_no (int): The number of halfmoves replayed.
+          seconds (float): The total time taken to analyse the games.
+          aborted_no (int): The number of games whose replay stopped
+          early on an unsupported move.
+          max_seconds (float): The time taken by the slowest game.
+          slowest_url (str): The URL of the slowest game.
+        """
+        self.conn.execute('''
+        INSERT INTO game_costs
+        (username, variant, gamesNo, halfmovesNo, seconds, abortedNo, maxSeconds, slowestUrl)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (username, variant) DO UPDATE SET
+            gamesNo = gamesNo + excluded.gamesNo,
+            halfmovesNo = halfmovesNo + excluded.halfmovesNo,
+            seconds = seconds + excluded.seconds,
+            abortedNo = abortedNo + excluded.abortedNo,
+            maxSeconds = MAX(maxSeconds, excluded.maxSeconds),
+            slowestUrl = CASE WHEN excluded.maxSeconds > maxSeconds
+                THEN excluded.slowestUrl ELSE slowestUrl END
+        ''', (username, variant, games_no, halfmoves_no, seconds,
+              aborted_no, max_seconds, slowest_url))
+
+    def get_num_games(self, username):
+        """Retrieve user's total number of rated and casual games.
+
+        Args:
+          username (str): The username of the user.
+
+        Returns:
+          tuple: A tuple containing:
+            - int: The total number of rated games.
+            - int: The total number of casual games.
+        """
+        cursor = self.conn.execute('''
+        SELECT ratedGames, casualGames FROM users WHERE username = ?
+        ''', (username,))
+        return cursor.fetchone()
+
+    def get_stats(self, username, game_type):
+        """Retrieve the en passant statistics for a user.
+
+        Args:
+          username (str): The username of the user.
+          game_type (str): The type of game ('rated' or 'casual').
+
+        Returns:
+          tuple: A tuple containing:
+            - int: The number of en passants accepted.
+            - int: The number of en passants declined.
+            - int: The timestamp of the latest game analysed, or
+              `None` if unknown.
+        """
+        cursor = self.conn.execute('''
+        SELECT acceptedNo, declinedNo, lastGameAt FROM user_stats
+        WHERE username = ? AND gameType = ?
+        ''', (username, game_type))
+        return cursor.fetchone()
+
+    def get_urls(self, username, game_type, accepted):
+        """Retrieve the URLs for en passant opportunities for a user.
+
+        Args:
+          username (str): The username of the user.
+          game_type (str): The type of game ('rated' or 'casual').
+          accepted (bool): Whether en passant was accepted.
+
+        Returns:
+          list: A list of tuples, where each tuple contains:
+            - str: The URL of the game.
+            - str: The opponent's username.
+        """
+        cursor = self.conn.execute('''
+        SELECT url, opponent FROM user_urls WHERE username = ? AND gameType = ? AND accepted = ?
+        ''', (username, game_type, accepted))
+        return cursor.fetchall()
+    
+    def get_filter_stats(self, username, filter_key, game_type):
+        """Retrieve the en passant statistics for a set of game filters.
+
+        Args:
+          username (str): The username of the user.
+          filter_key (str): The canonical key of the game filters.
+          game_type (str): The type of game ('rated' or 'casual').
+
+        Returns:
+          tuple: A tuple containing:
+            - int: The number of games matching the filters.
+            - int: The number of en passants accepted.
+            - int: The number of en passants declined.
+            - int: The timestamp of the latest game analysed.
+          `None` if the filters have not been analysed for the user.
+        """
+        cursor = self.conn.execute('''
+        SELECT gamesNo, acceptedNo, declinedNo, lastGameAt FROM filter_stats
+        WHERE username = ? AND filterKey = ? AND gameType = ?
+        ''', (username, filter_key, game_type))
+        return cursor.fetchone()
+
+    def get_filter_urls(self, username, filter_key, game_type, accepted):
+        """Retrieve the URLs for en passant opportunities matching filters.
+
+        Args:
+          username (str): The username of the user.
+          filter_key (str): The canonical key of the game filters.
+          game_type (str): The type of game ('rated' or 'casual').
+          accepted (bool): Whether en passant was accepted.
+
+        Returns:
+          list: A list of tuples, where each tuple contains:
+            - str: The URL of the game.
+            - str: The opponent's username.
+        """
+        cursor = self.conn.execute('''
+        SELECT url, opponent FROM filter_urls
+        WHERE username = ? AND filterKey = ? AND gameType = ? AND accepted = ?
+        ''', (username, filter_key, game_type, accepted))
+        return cursor.fetchall()
+
+    def user_exists(self, username):
+        """Check if a user exists in the database.
+
+        Args:
+          username (str): The username of the user.
+
+        Returns:
+          bool: True if the user exists, False otherwise.
+        """
+        cursor = self.conn.execute('''
+        SELECT 1 FROM users WHERE username = ?
+        ''', (username,))
+        return cursor.fetchone() is not None
+    
+    def get_percentage_leaderboard(self):
+        """Retrieve the leaderboard sorted by acceptance %.
+
+        Returns:
+          list: A list of tuples, where each tuple contains:
+            - str: The username.
+            - int: The total number of en passant opportunities.
+            - float: The percentage of en passant captures accepted.
+        """
+        cursor = self.conn.execute('''
+            SELECT u.username,
+            (SUM(s.acceptedNo) + SUM(s.declinedNo)) AS opportunities,
+            (CAST(SUM(s.acceptedNo) AS FLOAT) / (SUM(s.acceptedNo) + SUM(s.declinedNo))) * 100 AS acceptedPercentage
+            FROM user_stats s
+            JOIN users u ON s.username = u.username
+            GROUP BY u.username
+            HAVING opportunities > 0
+            ORDER BY acceptedPercentage;
+        ''')
+        return cursor.fetchall()
+
+    def get_declined_leaderboard(self):
+        """Retrieve the leaderboard sorted by the total declines.
+
+        Returns:
+          list: A list of tuples, where each tuple contains:
+            - str: The username.
+            - int: The total number of games played.
+            - int: The total number of en passant captures declined.
+        """
+        cursor = self.conn.execute('''
+            SELECT u.username,
+            (u.ratedGames + u.casualGames) AS totalGames,
+            SUM(s.declinedNo) AS totalDeclined
+            FROM users u
+            JOIN user_stats s ON u.username = s.username
+            GROUP BY u.username
+            ORDER BY totalDeclined DESC;
+        ''')
+        return cursor.fetchall()
+
+    def get_allowed_leaderboard(self, limit):
+        """Retrieve the players who allowed the most en passants.
+
+        Args:
+          limit (int): The max number of players to retrieve.
+
+        Returns:
+          list: A list of tuples, sorted by opportunities, containing:
+            - str: The username of the player who allowed them.
+            - int: The number of en passant opportunities allowed.
+            - float: The percentage of them captured by the opponent.
+        """
+        cursor = self.conn.execute('''
+            SELECT username,
+            allowedNo,
+            CAST(acceptedNo AS FLOAT) / allowedNo * 100
+            FROM allowed_stats
+            ORDER BY allowedNo DESC
+            LIMIT ?;
+        ''', (limit,))
+        return cursor.fetchall()
+
+    def get_head_to_head(self, player, allowed_by):
+        """Retrieve the en passant opportunities one player allowed another.
+
+        Args:
+          player (str): The case-insensitive username of the player
+          with the opportunities.
+          allowed_by (str): The case-insensitive username of the
+          player who allowed them.
+
+        Returns:
+          list: A list of tuples, where each tuple contains:
+            - str: The URL of the game at the opportunity.
+            - bool: Whether the en passant was accepted.
+        """
+        cursor = self.conn.execute('''
+        SELECT url, accepted FROM opportunities
+        WHERE player = ? AND allowedBy = ?
+        ''', (player, allowed_by))
+        return cursor.fetchall()
+
+    def get_slowest_users(self, limit):
+        """Retrieve the users whose games took longest to analyse.
+
+        Args:
+          limit (int): The max number of users to retrieve.
+
+        Returns:
+          list: A list of tuples, sorted by total time, containing:
+            - str: The username.
+            - int: The number of games analysed.
+            - int: The number of halfmoves replayed.
+            - float: The total time taken in seconds.
+            - float: The average time per game in milliseconds.
+            - int: The number of games whose replay was aborted.
+            - float: The time taken by the slowest game in seconds.
+            - str: The URL of the slowest game.
+        """
+        cursor = self.conn.execute('''
+            SELECT c.username,
+            SUM(c.gamesNo),
+            SUM(c.halfmovesNo),
+            SUM(c.seconds) AS totalSeconds,
+            SUM(c.seconds) * 1000 / SUM(c.gamesNo),
+            SUM(c.abortedNo),
+            MAX(c.maxSeconds),
+            (SELECT s.slowestUrl FROM game_costs s WHERE s.username = c.username
+             ORDER BY s.maxSeconds DESC LIMIT 1)
+            FROM game_costs c
+            GROUP BY c.username
+            HAVING SUM(c.gamesNo) > 0
+            ORDER BY totalSeconds DESC
+            LIMIT ?;
+        ''', (limit,))
+        return cursor.fetchall()
+
+    def get_slowest_variants(self):
+        """Retrieve the variants sorted by average time per game.
+
+        Returns:
+          list: A list of tuples containing:
+            - str: The variant name.
+            - int: The number of games analysed.
+            - float: The average halfmoves replayed per game.
+            - float: The total time taken in seconds.
+            - float: The average time per game in milliseconds.
+            - int: The number of games whose replay was aborted.
+            - float: The time taken by the slowest game in seconds.
+            - str: The URL of the slowest game.
+        """
+        cursor = self.conn.execute('''
+            SELECT c.variant,
+            SUM(c.gamesNo),
+            CAST(SUM(c.halfmovesNo) AS FLOAT) / SUM(c.gamesNo),
+            SUM(c.seconds),
+            SUM(c.seconds) * 1000 / SUM(c.gamesNo) AS averageMs,
+            SUM(c.abortedNo),
+            MAX(c.maxSeconds),
+            (SELECT s.slowestUrl FROM game_costs s WHERE s.variant = c.variant
+             ORDER BY s.maxSeconds DESC LIMIT 1)
+            FROM game_costs c
+            GROUP BY c.variant
+            HAVING SUM(c.gamesNo) > 0
+            ORDER BY averageMs DESC;
+        ''')
+        return cursor.fetchall()
+
+    def close(self):
+        """Close the database connection."""
         self.conn.close()
\ No newline at end of file
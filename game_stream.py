@@ -0,0 +1,138 @@
+"""
+game_stream.py
+
+This module provides a `GameStream` class which downloads games in a
+background thread ahead of their analysis, holding at most a bounded
+number and size of games in memory at once.
+
+When the buffer is full the download pauses, so a slow analysis or
+database write holds back the download instead of queuing up every
+game of a huge account (backpressure). Closing the stream stops the
+download part way through. Waits for the next game are bounded by an
+optional deadline, so a stalled download cannot hold up the consumer.
+
+Classes:
+    GameStream: Bounded buffer of games between a download and its
+    consumer.
+"""
+
+
+import threading
+from collections import deque
+from time import monotonic
+
+from lichess_api import LichessErrorHandler
+
+
+class GameStream:
+    """Iterable of games downloaded ahead by a background thread."""
+    def __init__(self, games, max_games, max_bytes, deadline=None):
+        """Initialise the stream without starting the download.
+
+        Args:
+          games (iterator[str]): The PGN strings of the games, e.g.
+          from `lichess_api.stream_user_games`. Iterated in the
+          background thread, so the download starts on the first
+          iteration of the stream.
+          max_games (int): The max games downloaded but not yet
+          consumed.
+          max_bytes (int): The max size of games downloaded but not yet
+          consumed, counting characters as bytes since PGN is mostly
+          ASCII. A single larger game is still let through.
+          deadline (float, optional): The `time.monotonic()` time after
+          which iteration stops waiting for games, marking the stream
+          interrupted. Defaults to `None`, which waits indefinitely.
+        """
+        self._games = games
+        self._max_games = max_games
+        self._max_bytes = max_bytes
+        self._deadline = deadline
+
+        self._buffer = deque()
+        self._buffered_bytes = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._finished = False
+        self._closed = False
+        self._error = None
+
+        # Whether the download failed or ran out of time part way through
+        self.interrupted = False
+
+    def __iter__(self):
+        """Yield the games in download order, waiting for each.
+
+        Raises:
+          APIError: If the Lichess API responded with an error.
+        """
+        with self._condition:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._download, daemon=True)
+                self._thread.start()
+
+        while True:
+            with self._condition:
+                timeout = None if self._deadline is None else self._deadline - monotonic()
+                if not self._condition.wait_for(lambda: self._buffer or self._finished, timeout):
+                    # Out of time waiting for the download
+                    self.interrupted = True
+                    break
+
+                if not self._buffer:
+                    break
+
+                pgn = self._buffer.popleft()
+                self._buffered_bytes -= len(pgn)
+                # Let the download continue if it was waiting for space
+                self._condition.notify_all()
+
+            yield pgn
+
+        if self._error is not None:
+            raise self._error
+
+    def _download(self):
+        """Move games into the buffer, waiting while it is full."""
+        try:
+            for pgn in self._games:
+                with self._condition:
+                    self._condition.wait_for(lambda: self._closed or self._has_space(len(pgn)))
+
+                    if self._closed:
+                        break
+
+                    self._buffer.append(pgn)
+                    self._buffered_bytes += len(pgn)
+                    self._condition.notify_all()
+        except LichessErrorHandler.APIError as e:
+            # Error responses are raised to the consumer
+            self._error = e
+        except Exception:
+            # Lost connections end the stream early
+            self.interrupted = True
+        finally:
+            if hasattr(self._games, 'close'):
+                # Stop the download, e.g. when closed before the end
+                self._games.close()
+
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def _has_space(self, num_bytes):
+        """Check whether a game of `num_bytes` fits in the buffer."""
+        if not self._buffer:
+            return True
+        return (
+            len(self._buffer) < self._max_games
+            and self._buffered_bytes + num_bytes <= self._max_bytes
+        )
+
+    def close(self):
+        """Stop the download and discard any games not yet consumed."""
+        with self._condition:
+            self._closed = True
+            self._buffer.clear()
+            self._buffered_bytes = 0
+            self._finished = self._finished or self._thread is None
+            self._condition.notify_all()
@@ -1,133 +1,292 @@
-import requests
-
-
-# Default 3 newlines between PGN strings of games from Lichess API
-PGN_DELIMITER = '\n' * 3
-
-
-class LichessErrorHandler:
-    """Utility class for handling Lichess API HTTP erros."""
-    class APIError(Exception):
-        """Base exception for Lichess API errors."""
-        pass
-
-    class UserNotFoundError(APIError):
-        """Exception raised when the username is invalid (404)."""
-        pass
-
-    class ServerError(APIError):
-        """Exception raised for server-side errors (500+)."""
-        pass
-
-    @staticmethod
-    def handle(username, status_code):
-        """Handle Lichess API errors based on the HTTP status code.
-
-        Args:
-          username (str): The username for which the error occured.
-          status_code (int) The HTTP status code returned.
-
-        Raises:
-          UserNotFoundError: If the status code is 404.
-          ServerError: If the status code is 500-599.
-          APIError: For all other non-successful status codes.
-        """
-        if status_code == 404:
-            raise LichessErrorHandler.UserNotFoundError(
-                f"404 User '{username}' not found!"
-            )
-        elif 500 <= status_code < 600:
-            raise LichessErrorHandler.ServerError(
-                f'{status_code} Lichess server error!'
-            )
-        else:
-            raise LichessErrorHandler.APIError(
-                f"{status_code} Failed to retrieve games for '{username}'!"
-            )
-
-
-def get_user_info(username):
-    """Retrieve user information from the Lichess API.
-
-    Fetches the case-sensitive username, total number of rated games,
-    and total number of casual games for the specified user.
-    This will be >= length of the games list retrieved subsequently
-    due to missing games in the Lichess database during a certain
-    time period. Handles cases where the username is invalid or
-    the API response is incomplete.
-
-    Args:
-      username (str): The username to retrieve information for.
-
-    Returns:
-      tuple: A tuple containing:
-        - str: The case-sensitive username.
-        - int: The total number of rated games.
-        - int: The total number of casual games.
-
-    Raises:
-      UserNotFoundError: If the username is invalid or not found.
-      ServerError: If the Lichess server encounters an error.
-      APIError: For other API-related errors.
-    """
-    url = f'https://lichess.org/api/user/{username}'
-    response = requests.get(url)
-
-    # Status code 200 is OK successful response
-    if response.status_code == 200:
-        user_data = response.json()
-        
-        try:
-            user_games_data = user_data['count']
-        except KeyError:
-            # Some invalid usernames still get 200 status code
-            LichessErrorHandler.handle(username, 404);
-        
-        return (
-            user_data['username'],
-            user_games_data['rated'],
-            user_games_data['all'] - user_games_data['rated']
-        )
-
-    LichessErrorHandler.handle(username, response.status_code)
-
-
-def get_user_games(username, is_rated, num_new_games=None):
-    """Retrieve games for a user from the Lichess API.
-    
-    Fetches all rated or casual games for the specified user.
-    Optionally, retrieves only the latest `num_new_games` games.
-    Returns the games as a list of PGN strings.
-
-    Args:
-      username (str): The username to retrieve games for.
-      is_rated (bool): Whether to retrieve rated games (`True`)
-      or casual games (`False`).
-      num_new_games (int, optional): The max number of latest games
-      to retrieve. Defaults to `None`, which retrieves all games.
-
-    Returns:
-      list[str]: A list of PGN strings representing the games.
-
-    Raises:
-      UserNotFoundError: If the username is invalid or not found.
-      ServerError: If the Lichess server encounters an error.
-      APIError: For other API-related errors.
-    """
-    url = f'https://lichess.org/api/games/user/{username}?rated='
-
-    url += 'true' if is_rated else 'false'
-
-    if num_new_games is not None:
-        url += f'&max={num_new_games}'
-
-    response = requests.get(url)
-
-    # Status code 200 is OK successful response
-    if response.status_code == 200:
-        # Split PGNs by triple newlines and filter out empty strings
-        return [
-            game for game in response.text.split(PGN_DELIMITER) if game.strip()
-        ][::-1]  # Returns games from oldest to newest
-    
-    LichessErrorHandler.handle(username, response.status_code)
\ No newline at end of file
+import os
+
+
+# Base URL of the Lichess API, can be overridden to point at a stand-in
+# such as `lichess_stub` with the environment variable or `set_base_url`
+LICHESS_API_URL = os.environ.get('LICHESS_API_URL', 'https://lichess.org')
+
+# Default 3 newlines between PGN strings of games from Lichess API
+PGN_DELIMITER = '\n' * 3
+
+# Game filters supported as query parameters by the Lichess export API
+EXPORT_FILTER_PARAMS = ['perfType', 'color', 'since', 'until']
+# Characters of a streamed export read at a time
+STREAM_CHUNK_SIZE = 64 * 1024
+# Seconds to wait to connect to the Lichess API, and between bytes of
+# its responses, before giving up
+REQUEST_TIMEOUT = (10, 30)
+
+# Lichess performance types of variants ('perfType' in the Lichess API)
+VARIANT_PERF_TYPES = {
+    'Chess960': 'chess960',
+    'Crazyhouse': 'crazyhouse',
+    'Antichess': 'antichess',
+    'Atomic': 'atomic',
+    'Horde': 'horde',
+    'King of the Hill': 'kingOfTheHill',
+    'Racing Kings': 'racingKings',
+    'Three-check': 'threeCheck'
+}
+# Lichess speeds of standard games by max estimated game duration
+# in seconds, where estimated duration = initial time + 40 * increment
+SPEED_PERF_TYPES = [
+    (29, 'ultraBullet'),
+    (179, 'bullet'),
+    (479, 'blitz'),
+    (1499, 'rapid')
+]
+CLASSICAL = 'classical'
+CORRESPONDENCE = 'correspondence'
+
+# Player colours ('color' in the Lichess API)
+COLORS = ['white', 'black']
+
+
+class LichessErrorHandler:
+    """Utility class for handling Lichess API HTTP erros."""
+    class APIError(Exception):
+        """Base exception for Lichess API errors."""
+        pass
+
+    class UserNotFoundError(APIError):
+        """Exception raised when the username is invalid (404)."""
+        pass
+
+    class RateLimitError(APIError):
+        """Exception raised when too many requests have been made (429)."""
+        pass
+
+    class ServerError(APIError):
+        """Exception raised for server-side errors (500+)."""
+        pass
+
+    @staticmethod
+    def handle(username, status_code):
+        """Handle Lichess API errors based on the HTTP status code.
+
+        Args:
+          username (str): The username for which the error occured.
+          status_code (int) The HTTP status code returned.
+
+        Raises:
+          UserNotFoundError: If the status code is 404.
+          RateLimitError: If the status code is 429.
+          ServerError: If the status code is 500-599.
+          APIError: For all other non-successful status codes.
+        """
+        if status_code == 404:
+            raise LichessErrorHandler.UserNotFoundError(
+                f"404 User '{username}' not found!"
+            )
+        elif status_code == 429:
+            raise LichessErrorHandler.RateLimitError(
+                '429 Too many requests to Lichess, please try again in a minute!'
+            )
+        elif 500 <= status_code < 600:
+            raise LichessErrorHandler.ServerError(
+                f'{status_code} Lichess server error!'
+            )
+        else:
+            raise LichessErrorHandler.APIError(
+                f"{status_code} Failed to retrieve games for '{username}'!"
+            )
+
+
+def set_base_url(url):
+    """Set the base URL of the Lichess API, e.g. 'http://localhost:8080'."""
+    global LICHESS_API_URL
+    LICHESS_API_URL = url.rstrip('/')
+
+
+def get_speed(time_control):
+    """Return the Lichess speed of a standard time control.
+
+    Speeds are classified by estimated game duration, as by Lichess.
+
+    Args:
+      time_control (str): The time control as initial seconds and
+      increment, e.g. '180+2'.
+
+    Returns:
+      str: The speed, e.g. 'blitz'.
+    """
+    initial, increment = time_control.split('+')
+    duration = int(initial) + 40 * int(increment)
+
+    for max_duration, speed in SPEED_PERF_TYPES:
+        if duration <= max_duration:
+            return speed
+
+    return CLASSICAL
+
+
+def get_user_info(username):
+    """Retrieve user information from the Lichess API.
+
+    Fetches the case-sensitive username, total number of rated games,
+    and total number of casual games for the specified user.
+    This will be >= length of the games list retrieved subsequently
+    due to missing games in the Lichess database during a certain
+    time period. Handles cases where the username is invalid or
+    the API response is incomplete.
+
+    Args:
+      username (str): The username to retrieve information for.
+
+    Returns:
+      tuple: A tuple containing:
+        - str: The case-sensitive username.
+        - int: The total number of rated games.
+        - int: The total number of casual games.
+
+    Raises:
+      UserNotFoundError: If the username is invalid or not found.
+      RateLimitError: If too many requests have been made.
+      ServerError: If the Lichess server encounters an error or does
+      not respond in time.
+      APIError: For other API-related errors.
+    """
+    # Imported on first use to keep startup of the web process light
+    import requests
+
+    url = f'{LICHESS_API_URL}/api/user/{username}'
+
+    try:
+        response = requests.get(url, timeout=REQUEST_TIMEOUT)
+    except requests.Timeout:
+        raise LichessErrorHandler.ServerError('Timed out waiting for Lichess to respond!')
+
+    # Status code 200 is OK successful response
+    if response.status_code == 200:
+        user_data = response.json()
+        
+        try:
+            user_games_data = user_data['count']
+        except KeyError:
+            # Some invalid usernames still get 200 status code
+            LichessErrorHandler.handle(username, 404);
+        
+        return (
+            user_data['username'],
+            user_games_data['rated'],
+            user_games_data['all'] - user_games_data['rated']
+        )
+
+    LichessErrorHandler.handle(username, response.status_code)
+
+
+def get_user_games(username, is_rated, num_new_games=None, filters=None):
+    """Retrieve games for a user from the Lichess API.
+    
+    Fetches all rated or casual games for the specified user.
+    Optionally, retrieves only the latest `num_new_games` games.
+    Game filters supported by the API are passed in the query so that
+    only matching games are downloaded.
+    Returns the games as a list of PGN strings.
+
+    Args:
+      username (str): The username to retrieve games for.
+      is_rated (bool): Whether to retrieve rated games (`True`)
+      or casual games (`False`).
+      num_new_games (int, optional): The max number of latest games
+      to retrieve. Defaults to `None`, which retrieves all games.
+      filters (dict, optional): Game filters keyed by Lichess query
+      parameter, e.g. `{'perfType': 'blitz'}`. Defaults to `None`.
+
+    Returns:
+      list[str]: A list of PGN strings representing the games.
+
+    Raises:
+      UserNotFoundError: If the username is invalid or not found.
+      RateLimitError: If too many requests have been made.
+      ServerError: If the Lichess server encounters an error.
+      APIError: For other API-related errors.
+    """
+    games = stream_user_games(username, is_rated, num_new_games, filters)
+
+    # Returns games from oldest to newest
+    return list(games)[::-1]
+
+
+def stream_user_games(username, is_rated, num_new_games=None, filters=None,
+                      oldest_first=False, moves=True):
+    """Stream games for a user from the Lichess API.
+
+    Like `get_user_games`, but yields games one at a time as they are
+    downloaded, so only one game is held in memory at once. The
+    request is sent on the first iteration, and the download pauses
+    whenever the caller stops iterating. If Lichess stops sending for
+    longer than the read timeout, iteration raises
+    `requests.ConnectionError`.
+
+    Args:
+      username (str): The username to retrieve games for.
+      is_rated (bool): Whether to retrieve rated games (`True`)
+      or casual games (`False`).
+      num_new_games (int, optional): The max number of games to
+      retrieve. Defaults to `None`, which retrieves all games.
+      filters (dict, optional): Game filters keyed by Lichess query
+      parameter, e.g. `{'perfType': 'blitz'}`. Defaults to `None`.
+      oldest_first (bool, optional): Whether to stream games from
+      oldest to newest. Defaults to `False`, newest to oldest.
+      moves (bool, optional): Whether to include the moves, or only
+      the headers, of each game. Defaults to `True`.
+
+    Yields:
+      str: The PGN string of each game.
+
+    Raises:
+      UserNotFoundError: If the username is invalid or not found.
+      RateLimitError: If too many requests have been made.
+      ServerError: If the Lichess server encounters an error or does
+      not respond in time.
+      APIError: For other API-related errors.
+    """
+    # Imported on first use to keep startup of the web process light
+    import requests
+
+    url = f'{LICHESS_API_URL}/api/games/user/{username}?rated='
+
+    url += 'true' if is_rated else 'false'
+
+    if num_new_games is not None:
+        url += f'&max={num_new_games}'
+
+    for param in EXPORT_FILTER_PARAMS:
+        if filters and param in filters:
+            url += f'&{param}={filters[param]}'
+
+    if oldest_first:
+        url += '&sort=dateAsc'
+
+    if not moves:
+        url += '&moves=false'
+
+    try:
+        response = requests.get(url, stream=True, timeout=REQUEST_TIMEOUT)
+    except requests.Timeout:
+        raise LichessErrorHandler.ServerError('Timed out waiting for Lichess to respond!')
+
+    # Status code 200 is OK successful response
+    if response.status_code != 200:
+        response.close()
+        LichessErrorHandler.handle(username, response.status_code)
+
+    # PGN exports are UTF-8 but not always labelled as such
+    response.encoding = 'utf-8'
+    buffered = ''
+
+    try:
+        for chunk in response.iter_content(STREAM_CHUNK_SIZE, decode_unicode=True):
+            buffered += chunk
+
+            # Split PGNs by triple newlines, keeping any incomplete game
+            *games, buffered = buffered.split(PGN_DELIMITER)
+            for game in games:
+                if game.strip():
+                    yield game
+
+        if buffered.strip():
+            yield buffered
+    finally:
+        response.close()
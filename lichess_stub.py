@@ -0,0 +1,381 @@
+"""
+lichess_stub.py
+
+A local stand-in for the parts of the Lichess API used by
+`lichess_api`, serving a generated corpus of games so that the
+application can be load and latency tested without hitting
+lichess.org.
+
+Every username exists, with games generated deterministically from
+the username on first request. Games are exported as PGN, or as
+NDJSON if requested with the 'Accept: application/x-ndjson' header,
+and streamed one game per chunk like the real API.
+
+Endpoints:
+    - /api/user/{username}: Public user data with game counts.
+    - /api/games/user/{username}: Games of the user, from newest to
+      oldest, supporting the 'rated', 'max', 'since', 'until',
+      'color', 'perfType', 'sort' and 'moves' query parameters.
+
+Server behaviour can be degraded to resemble lichess.org under load:
+    - latency: Seconds to wait before responding to each request.
+    - games_per_second: Max rate at which exported games are streamed.
+    - requests_per_minute: Max requests in any 60 seconds before
+      responding with 429 Too Many Requests.
+    - error_rate: Fraction of requests failing with a random 5xx.
+
+Usage:
+    python lichess_stub.py [--port 8080] [--games 200] [--latency 0.2]
+    python main.py --lichess-url http://localhost:8080
+"""
+
+
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import chess
+import chess.pgn
+
+from lichess_api import get_speed
+
+
+# Fraction of generated games which are rated
+RATED_FRACTION = 0.75
+# Max halfmoves played in a generated game
+MAX_HALFMOVES = 120
+# Time controls of generated games
+TIME_CONTROLS = ['60+0', '180+0', '180+2', '300+3', '600+0', '900+10', '1800+0']
+# Start time of the first generated game of every user
+CORPUS_START = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+# Status codes of injected server errors
+SERVER_ERRORS = [500, 502, 503]
+
+PGN_CONTENT_TYPE = 'application/x-chess-pgn'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def generate_game(rng, username, game_num, is_rated):
+    """Generate a random game played by a user.
+
+    Args:
+      rng (random.Random): The random number generator to use.
+      username (str): The username of the player.
+      game_num (int): The number of the game, used as its start time
+      offset in hours from `CORPUS_START`.
+      is_rated (bool): Whether the game is rated.
+
+    Returns:
+      dict: The game, with keys:
+        - 'rated' (bool): Whether the game is rated.
+        - 'createdAt' (int): The start time in milliseconds.
+        - 'speed' (str): The Lichess speed of the game.
+        - 'white' (str): The username of the white player.
+        - 'black' (str): The username of the black player.
+        - 'pgn' (str): The PGN string of the game.
+        - 'ndjson' (str): The JSON line of the game.
+    """
+    board = chess.Board()
+
+    for _ in range(rng.randint(10, MAX_HALFMOVES)):
+        if board.is_game_over():
+            break
+        board.push(rng.choice(list(board.legal_moves)))
+
+    game = chess.pgn.Game.from_board(board)
+    opponent = f'opponent{rng.randint(1, 50)}'
+    white, black = (username, opponent) if rng.random() < 0.5 else (opponent, username)
+    ratings = {'white': rng.randint(800, 2800), 'black': rng.randint(800, 2800)}
+    time_control = rng.choice(TIME_CONTROLS)
+    start = CORPUS_START + timedelta(hours=game_num)
+    game_id = ''.join(rng.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=8))
+
+    game.headers.update({
+        'Event': f"{'Rated' if is_rated else 'Casual'} game",
+        'Site': f'https://lichess.org/{game_id}',
+        'Date': start.strftime('%Y.%m.%d'),
+        'White': white,
+        'Black': black,
+        'UTCDate': start.strftime('%Y.%m.%d'),
+        'UTCTime': start.strftime('%H:%M:%S'),
+        'WhiteElo': str(ratings['white']),
+        'BlackElo': str(ratings['black']),
+        'Variant': 'Standard',
+        'TimeControl': time_control,
+        'Termination': 'Normal'
+    })
+    if game.headers['Result'] == '*':
+        game.headers['Result'] = rng.choice(['1-0', '0-1', '1/2-1/2'])
+
+    created_at = int(start.timestamp() * 1000)
+    speed = get_speed(time_control)
+
+    ndjson = {
+        'id': game_id,
+        'rated': is_rated,
+        'variant': 'standard',
+        'speed': speed,
+        'perf': speed,
+        'createdAt': created_at,
+        'lastMoveAt': created_at + 1000 * len(board.move_stack),
+        'status': 'mate' if board.is_checkmate() else 'resign',
+        'players': {
+            color: {'user': {'name': name, 'id': name.lower()}, 'rating': ratings[color]}
+            for color, name in [('white', white), ('black', black)]
+        },
+        'moves': ' '.join(node.san() for node in game.mainline())
+    }
+    winner = {'1-0': 'white', '0-1': 'black'}.get(game.headers['Result'])
+    if winner is not None:
+        ndjson['winner'] = winner
+
+    return {
+        'rated': is_rated,
+        'createdAt': created_at,
+        'speed': speed,
+        'white': white,
+        'black': black,
+        'pgn': str(game),
+        'ndjson': json.dumps(ndjson)
+    }
+
+
+def generate_games(username, num_games):
+    """Generate the games of a user, from newest to oldest.
+
+    Args:
+      username (str): The username of the player.
+      num_games (int): The number of games to generate.
+
+    Returns:
+      list[dict]: The games, as returned by `generate_game`.
+    """
+    rng = random.Random(zlib.crc32(username.lower().encode()))
+    games = []
+
+    for game_num in range(num_games):
+        is_rated = rng.random() < RATED_FRACTION
+        games.append(generate_game(rng, username, game_num, is_rated))
+
+    return games[::-1]
+
+
+class StubLichessServer(ThreadingHTTPServer):
+    """HTTP server holding the generated game corpus."""
+    daemon_threads = True
+
+    def __init__(self, address, games_per_user, latency=0, games_per_second=None,
+                 requests_per_minute=None, error_rate=0, seed=0):
+        """Initialise the server.
+
+        Args:
+          address (tuple): The host and port to listen on.
+          games_per_user (int): The number of games of every user.
+          latency (float, optional): Seconds to wait before responding.
+          Defaults to 0.
+          games_per_second (float, optional): Max rate at which games
+          are streamed. Defaults to `None`, which is unlimited.
+          requests_per_minute (int, optional): Max requests in any 60
+          seconds before responding with 429. Defaults to `None`,
+          which is unlimited.
+          error_rate (float, optional): Fraction of requests failing
+          with a 5xx status code. Defaults to 0.
+          seed (int, optional): The seed for injecting errors.
+          Defaults to 0.
+        """
+        super().__init__(address, StubLichessHandler)
+        self.games_per_user = games_per_user
+        self.latency = latency
+        self.games_per_second = games_per_second
+        self.requests_per_minute = requests_per_minute
+        self.error_rate = error_rate
+
+        self._corpus = {}
+        self._corpus_lock = threading.Lock()
+        self._request_times = deque()
+        self._errors_rng = random.Random(seed)
+        self._errors_lock = threading.Lock()
+
+    def get_games(self, username):
+        """Return the games of a user, generating them if needed."""
+        with self._corpus_lock:
+            if username.lower() not in self._corpus:
+                # Lowercase usernames are the case-sensitive ones
+                self._corpus[username.lower()] = generate_games(
+                    username.lower(), self.games_per_user
+                )
+            return self._corpus[username.lower()]
+
+    def get_injected_error(self):
+        """Return the error status code to respond with, if any.
+
+        Returns:
+          int: 429 if over the request rate limit, a random 5xx status
+          code at the configured error rate, otherwise `None`.
+        """
+        with self._errors_lock:
+            now = time.monotonic()
+
+            if self.requests_per_minute is not None:
+                # Forget requests older than a minute
+                while self._request_times and self._request_times[0] <= now - 60:
+                    self._request_times.popleft()
+
+                if len(self._request_times) >= self.requests_per_minute:
+                    return 429
+                self._request_times.append(now)
+
+            if self._errors_rng.random() < self.error_rate:
+                return self._errors_rng.choice(SERVER_ERRORS)
+
+        return None
+
+
+class StubLichessHandler(BaseHTTPRequestHandler):
+    """Request handler for the Lichess API endpoints."""
+    # Required for streaming bodies with chunked transfer encoding
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """Route GET requests to the user and games endpoints."""
+        url = urlparse(self.path)
+        query = {param: values[0] for param, values in parse_qs(url.query).items()}
+        parts = url.path.strip('/').split('/')
+
+        time.sleep(self.server.latency)
+
+        error = self.server.get_injected_error()
+        if error is not None:
+            self.send_error(error)
+        elif len(parts) == 3 and parts[:2] == ['api', 'user']:
+            self.send_user(parts[2])
+        elif len(parts) == 4 and parts[:3] == ['api', 'games', 'user']:
+            self.send_games(parts[3], query)
+        else:
+            self.send_error(404)
+
+    def send_user(self, username):
+        """Send the public data of a user as JSON."""
+        games = self.server.get_games(username)
+        num_rated = sum(game['rated'] for game in games)
+
+        body = json.dumps({
+            'id': username.lower(),
+            'username': username.lower(),
+            'count': {'all': len(games), 'rated': num_rated}
+        }).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_games(self, username, query):
+        """Stream the games of a user, from newest to oldest by default."""
+        games = self.server.get_games(username)
+
+        if 'rated' in query:
+            games = [game for game in games if game['rated'] == (query['rated'] == 'true')]
+        if 'since' in query:
+            games = [game for game in games if game['createdAt'] >= int(query['since'])]
+        if 'until' in query:
+            games = [game for game in games if game['createdAt'] <= int(query['until'])]
+        if 'color' in query:
+            games = [game for game in games if game[query['color']] == username.lower()]
+        if 'perfType' in query:
+            games = [game for game in games if game['speed'] in query['perfType'].split(',')]
+        if query.get('sort') == 'dateAsc':
+            games = games[::-1]
+        if 'max' in query:
+            games = games[:int(query['max'])]
+
+        if NDJSON_CONTENT_TYPE in self.headers.get('Accept', ''):
+            content_type = NDJSON_CONTENT_TYPE
+            chunks = (game['ndjson'] + '\n' for game in games)
+        elif query.get('moves') == 'false':
+            content_type = PGN_CONTENT_TYPE
+            # Headers are separated from the movetext by a blank line
+            chunks = (game['pgn'].split('\n\n')[0] + '\n\n\n' for game in games)
+        else:
+            content_type = PGN_CONTENT_TYPE
+            chunks = (game['pgn'] + '\n\n\n' for game in games)
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        start = time.monotonic()
+
+        for game_num, chunk in enumerate(chunks):
+            if self.server.games_per_second:
+                # Wait until this game is due under the throughput cap
+                delay = start + game_num / self.server.games_per_second - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+
+            chunk = chunk.encode()
+            try:
+                self.wfile.write(f'{len(chunk):X}\r\n'.encode() + chunk + b'\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                # Client stopped reading the stream part way through
+                return
+
+        # Zero length chunk ends the body
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        """Silence logging of every request."""
+        pass
+
+
+def main():
+    """Run the stub Lichess API server."""
+    parser = argparse.ArgumentParser(description='Run a local stand-in for the Lichess API.')
+    parser.add_argument('--host', type=str, default='localhost', help='The host to listen on.')
+    parser.add_argument('--port', type=int, default=8080, help='The port to listen on.')
+    parser.add_argument(
+        '--games', type=int, default=200, help='The number of games of every user.'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0, help='Seconds to wait before responding.'
+    )
+    parser.add_argument(
+        '--games-per-second', type=float, default=None,
+        help='Max rate at which games are streamed.'
+    )
+    parser.add_argument(
+        '--requests-per-minute', type=int, default=None,
+        help='Max requests per minute before responding with 429.'
+    )
+    parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='Fraction of requests failing with a 5xx status code.'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='The seed for injecting errors.')
+    args = parser.parse_args()
+
+    server = StubLichessServer(
+        (args.host, args.port),
+        args.games,
+        latency=args.latency,
+        games_per_second=args.games_per_second,
+        requests_per_minute=args.requests_per_minute,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )
+    print(f'Stub Lichess API running at http://{args.host}:{args.port}/')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+load_test.py
+
+Load test for the En Passant Analyser web app in production serve mode.
+
+Starts a stub Lichess API (see `lichess_stub`) and `main.py --serve`
+against a temporary database, then drives concurrent requests to `/`,
+`/results/<username>` and `/leaderboards` for a fixed duration and
+reports requests/sec and latency percentiles for each route.
+
+Usage:
+    python load_test.py [--workers 4] [--clients 8] [--duration 30]
+"""
+
+
+import argparse
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+from lichess_stub import StubLichessServer
+
+
+# Relative frequency of requests to each route
+ROUTE_WEIGHTS = {
+    'index': 5,
+    'results': 2,
+    'leaderboards': 3
+}
+# Seconds to wait for the app to start accepting connections
+STARTUP_TIMEOUT = 30
+
+
+def get_free_port():
+    """Return a free local TCP port."""
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(url, timeout):
+    """Wait until a server responds to GET requests to `url`."""
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.1)
+
+    raise RuntimeError(f'Server at {url} did not start within {timeout} seconds!')
+
+
+def percentile(sorted_values, fraction):
+    """Return the value at `fraction` of the way through sorted values."""
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run_client(app_url, usernames, deadline, latencies, errors, seed):
+    """Send weighted random requests to the app until the deadline.
+
+    Args:
+      app_url (str): The base URL of the app.
+      usernames (list[str]): The usernames to query results for.
+      deadline (float): The time at which to stop sending requests.
+      latencies (dict): Route names mapped to lists of latencies in
+      seconds, appended to for every successful request.
+      errors (dict): Route names mapped to lists of failed requests,
+      including error pages, which have non-2xx status codes.
+      seed (int): The seed for choosing routes and usernames.
+    """
+    rng = random.Random(seed)
+    session = requests.Session()
+    routes = list(ROUTE_WEIGHTS)
+    weights = list(ROUTE_WEIGHTS.values())
+
+    while time.time() < deadline:
+        route = rng.choices(routes, weights)[0]
+
+        if route == 'index':
+            path = '/'
+        elif route == 'results':
+            path = f'/results/{rng.choice(usernames)}'
+        else:
+            path = '/leaderboards'
+
+        start = time.perf_counter()
+        try:
+            response = session.get(app_url + path)
+        except requests.RequestException as e:
+            errors[route].append(str(e))
+            continue
+
+        if response.status_code == 200:
+            latencies[route].append(time.perf_counter() - start)
+        else:
+            errors[route].append(response.status_code)
+
+
+def main():
+    """Run the load test and print a report."""
+    parser = argparse.ArgumentParser(description='Load test the En Passant Analyser app.')
+    parser.add_argument('--workers', type=int, default=4, help='The number of app workers.')
+    parser.add_argument('--clients', type=int, default=8, help='The number of concurrent clients.')
+    parser.add_argument('--duration', type=float, default=30, help='The seconds to send requests for.')
+    parser.add_argument('--users', type=int, default=20, help='The number of distinct usernames.')
+    parser.add_argument('--games', type=int, default=200, help='The number of games of every user.')
+    parser.add_argument(
+        '--latency', type=float, default=0, help='Seconds the stub Lichess API waits to respond.'
+    )
+    parser.add_argument(
+        '--games-per-second', type=float, default=None,
+        help='Max rate at which the stub Lichess API streams games.'
+    )
+    args = parser.parse_args()
+
+    # Start the stub Lichess API in this process
+    stub = StubLichessServer(
+        ('localhost', get_free_port()),
+        args.games,
+        latency=args.latency,
+        games_per_second=args.games_per_second
+    )
+    threading.Thread(target=stub.serve_forever, daemon=True).start()
+    stub_url = f'http://localhost:{stub.server_address[1]}'
+
+    app_port = get_free_port()
+    app_url = f'http://localhost:{app_port}'
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        app = subprocess.Popen(
+            [
+                sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py'),
+                '--serve', '--workers', str(args.workers), '--port', str(app_port),
+                '--db', 'load_test.db', '--lichess-url', stub_url
+            ],
+            cwd=temp_dir,
+            stdout=subprocess.DEVNULL
+        )
+
+        try:
+            wait_for_server(app_url, STARTUP_TIMEOUT)
+
+            latencies = {route: [] for route in ROUTE_WEIGHTS}
+            errors = {route: [] for route in ROUTE_WEIGHTS}
+            usernames = [f'loadtester{user_num}' for user_num in range(args.users)]
+
+            # Generate games upfront so only the app is measured
+            for username in usernames:
+                stub.get_games(username)
+            deadline = time.time() + args.duration
+
+            clients = [
+                threading.Thread(
+                    target=run_client,
+                    args=(app_url, usernames, deadline, latencies, errors, seed)
+                )
+                for seed in range(args.clients)
+            ]
+            for client in clients:
+                client.start()
+            for client in clients:
+                client.join()
+        finally:
+            app.terminate()
+            app.wait()
+
+    print(f'{args.workers} workers, {args.clients} clients, {args.duration} seconds')
+    print(f"{'Route':<14}{'Requests':>10}{'Errors':>8}{'Req/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+
+    for route in ROUTE_WEIGHTS:
+        route_latencies = sorted(latencies[route])
+        print(
+            f'{route:<14}{len(route_latencies):>10}{len(errors[route]):>8}'
+            f'{len(route_latencies) / args.duration:>10.1f}'
+            f'{percentile(route_latencies, 0.5) * 1000:>10.1f}'
+            f'{percentile(route_latencies, 0.99) * 1000:>10.1f}'
+        )
+
+    all_latencies = sorted(sum(latencies.values(), []))
+    print(
+        f"{'total':<14}{len(all_latencies):>10}{sum(map(len, errors.values())):>8}"
+        f'{len(all_latencies) / args.duration:>10.1f}'
+        f'{percentile(all_latencies, 0.5) * 1000:>10.1f}'
+        f'{percentile(all_latencies, 0.99) * 1000:>10.1f}'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,117 +1,365 @@
-import argparse
-
-from flask import Flask, request, render_template, redirect, url_for
-from pathvalidate import is_valid_filename
-
-from lichess_api import LichessErrorHandler
-from utils import retrieve_games, analyse_games, update_database, get_leaderboards
-
-
-def main():
-    """Main entry point for the application."""
-    # Parse command-line arguments
-    parser = argparse.ArgumentParser(description='Run the En Passant Analyser Flask app.')
-    parser.add_argument(
-        '--db',
-        type=str,
-        default='en_passant_stats.db',
-        help='The name of the SQLite database file to use.'
-    )
-    db_name = parser.parse_args().db
-
-    # Validate database name
-    if not(db_name.endswith('.db') and is_valid_filename(db_name)):
-        raise ValueError('Usage: python main.py [--db valid_filename.db]')
-    
-    # Create and run the Flask app
-    app = create_app(db_name)
-    app.run()
-
-
-def create_app(db_name):
-    """Create and configure the Flask app."""
-    app = Flask(__name__)
-
-    @app.route('/', methods=['GET', 'POST'])
-    def index():
-        """Handle the main page of the application.
-
-        For GET requests, renders the index page with a form for the
-        user to input their username.
-        For POST requests, retrieves and analyses the user's games
-        for Lichess, update their statistics in the database,
-        and redirects to the results page for the user.
-
-        Returns:
-          Rendered HTML template for the index
-          or a redirect to the results page.
-        """
-        if request.method == 'POST':
-            form_username = request.form.get('username')
-
-            # Check if username is blank
-            if not form_username.strip():
-                return render_template('index.html', error='Username cannot be blank!')
-            
-            # Redirect to results page after getting form username
-            return redirect(url_for('results', username=form_username))
-        
-        return render_template('index.html')
-
-
-    @app.route('/results/<username>')
-    def results(username):
-        """Handle the results page for a specific user.
-
-        Retrieves the user's game data from lichess.org
-        analyses en passant statistics and updates the database,
-        then renders the results page.
-
-        Returns:
-          Rendered HTML template for the results page.
-        """
-        try:
-            (
-                username,
-                num_rated,
-                num_casual,
-                rated_list,
-                casual_list
-            ) = retrieve_games(db_name, username)
-        except (
-            LichessErrorHandler.APIError,
-            LichessErrorHandler.UserNotFoundError,
-            LichessErrorHandler.ServerError
-        ) as e:
-            # If HTTP error, redirect back to index with error message
-            return render_template('index.html', error=str(e))
-            
-        results = analyse_games(db_name, username, rated_list, casual_list)
-
-        update_database(db_name, username, num_rated, num_casual, results)
-
-        return render_template('results.html', username=username, results=results)
-
-
-    @app.route('/leaderboards')
-    def leaderboards():
-        """Handle the leaderboards page for the application.
-
-        Retrieves leaderboard data for en passant statistics from
-        the database and renders leaderboards page.
-
-        Returns:
-          Rendered HTML template for the leaderboards page. 
-        """
-        percentage_results, declined_results = get_leaderboards(db_name)
-        return render_template(
-            'leaderboards.html',
-            percentage_results=percentage_results,
-            declined_results=declined_results
-        )
-    
-    return app
-
-
-if __name__ == '__main__':
+import argparse
+from time import perf_counter
+
+from flask import Flask, request, render_template, redirect, url_for
+from pathvalidate import is_valid_filename
+
+from backup import export_database, import_database
+from lichess_api import LichessErrorHandler, set_base_url
+from utils import (
+    retrieve_games, analyse_games, update_database, get_leaderboards, parse_filters,
+    analysis_job, get_analysis_costs, get_statistics, get_allowed_leaderboard,
+    get_head_to_head, PERF_TYPES, DEFAULT_LIMITS
+)
+
+# Query string arguments of the game filters
+FILTER_ARGS = ['perfType', 'color', 'since', 'until']
+# HTTP status of the error page for each error of an analysis,
+# checked in order so subclasses come before their base classes
+ERROR_STATUSES = [
+    (LichessErrorHandler.UserNotFoundError, 404),
+    (LichessErrorHandler.RateLimitError, 429),
+    (LichessErrorHandler.APIError, 502),
+    (TimeoutError, 503)
+]
+
+
+def main():
+    """Main entry point for the application."""
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description='Run the En Passant Analyser Flask app.')
+    parser.add_argument(
+        '--db',
+        type=str,
+        default='en_passant_stats.db',
+        help='The name of the SQLite database file to use.'
+    )
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help='Run with the production WSGI server instead of the development server.'
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=4,
+        help='The number of requests served concurrently in production mode.'
+    )
+    parser.add_argument('--host', type=str, default='localhost', help='The host to listen on.')
+    parser.add_argument('--port', type=int, default=5000, help='The port to listen on.')
+    parser.add_argument(
+        '--lichess-url',
+        type=str,
+        default=None,
+        help='The base URL of the Lichess API, e.g. of a local stand-in.'
+    )
+    parser.add_argument(
+        '--max-games-in-flight',
+        type=int,
+        default=DEFAULT_LIMITS['maxGamesInFlight'],
+        help='The max games downloaded ahead of their analysis per request.'
+    )
+    parser.add_argument(
+        '--max-buffered-mb',
+        type=float,
+        default=DEFAULT_LIMITS['maxBufferedBytes'] / (1024 * 1024),
+        help='The max megabytes of games downloaded ahead of their analysis per request.'
+    )
+    parser.add_argument(
+        '--max-request-seconds',
+        type=float,
+        default=DEFAULT_LIMITS['maxSeconds'],
+        help='The max seconds analysing games per request before returning a partial result.'
+    )
+    parser.add_argument(
+        '--admin',
+        action='store_true',
+        help='Serve the administrator pages, e.g. /admin/costs.'
+    )
+    backup_group = parser.add_mutually_exclusive_group()
+    backup_group.add_argument(
+        '--export',
+        type=str,
+        default=None,
+        dest='export_path',
+        help='Export the database to a compressed NDJSON file and exit, e.g. backup.ndjson.gz.'
+    )
+    backup_group.add_argument(
+        '--import',
+        type=str,
+        default=None,
+        dest='import_path',
+        help='Import a file written by --export into an empty database and exit.'
+    )
+    args = parser.parse_args()
+    db_name = args.db
+
+    # Validate database name
+    if not(db_name.endswith('.db') and is_valid_filename(db_name)):
+        raise ValueError('Usage: python main.py [--db valid_filename.db]')
+
+    if args.export_path is not None or args.import_path is not None:
+        run_backup(db_name, args.export_path, args.import_path)
+        return
+
+    if args.workers < 1:
+        raise ValueError('Usage: python main.py --serve [--workers positive_integer]')
+
+    if min(args.max_games_in_flight, args.max_buffered_mb, args.max_request_seconds) <= 0:
+        raise ValueError(
+            'Usage: python main.py [--max-games-in-flight positive_integer] '
+            '[--max-buffered-mb positive_number] [--max-request-seconds positive_number]'
+        )
+
+    limits = {
+        'maxGamesInFlight': args.max_games_in_flight,
+        'maxBufferedBytes': int(args.max_buffered_mb * 1024 * 1024),
+        'maxSeconds': args.max_request_seconds
+    }
+    
+    if args.lichess_url is not None:
+        set_base_url(args.lichess_url)
+    
+    # Create and run the Flask app
+    app = create_app(db_name, limits, args.admin)
+
+    if args.serve:
+        from waitress import serve
+
+        # Each worker thread serves one request at a time
+        serve(app, host=args.host, port=args.port, threads=args.workers)
+    else:
+        app.run(host=args.host, port=args.port)
+
+
+def run_backup(db_name, export_path=None, import_path=None):
+    """Export or import the database and print the rows/sec achieved.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      export_path (str, optional): The file to export to.
+      Defaults to `None`.
+      import_path (str, optional): The file to import from, if not
+      exporting. Defaults to `None`.
+    """
+    start_time = perf_counter()
+
+    if export_path is not None:
+        action = 'Exported'
+        row_counts = export_database(db_name, export_path)
+    else:
+        action = 'Imported'
+        row_counts = import_database(db_name, import_path)
+
+    time_taken = perf_counter() - start_time
+    total_rows = sum(row_counts.values())
+
+    for table, rows in row_counts.items():
+        print(f'{table:<14}{rows:>12}')
+    print(
+        f'{action} {total_rows} rows in {time_taken:.2f} seconds '
+        f'({total_rows / max(time_taken, 1e-9):.0f} rows/sec)'
+    )
+
+
+def create_app(db_name, limits=None, admin=False):
+    """Create and configure the Flask app.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      limits (dict, optional): Limits on the analysis of each request
+      overriding `DEFAULT_LIMITS`. Defaults to `None`.
+      admin (bool, optional): Whether to serve the administrator pages,
+      which are not protected by any login. Defaults to `False`.
+    """
+    app = Flask(__name__)
+    limits = {**DEFAULT_LIMITS, **(limits or {})}
+
+    @app.route('/', methods=['GET', 'POST'])
+    def index():
+        """Handle the main page of the application.
+
+        For GET requests, renders the index page with a form for the
+        user to input their username.
+        For POST requests, retrieves and analyses the user's games
+        for Lichess, update their statistics in the database,
+        and redirects to the results page for the user, passing on
+        any game filters selected.
+
+        Returns:
+          Rendered HTML template for the index
+          or a redirect to the results page.
+        """
+        if request.method == 'POST':
+            form_username = request.form.get('username')
+
+            # Check if username is blank
+            if not form_username.strip():
+                return render_template(
+                    'index.html', perf_types=PERF_TYPES, error='Username cannot be blank!'
+                )
+
+            # Only pass on filters which were filled in
+            filter_args = {
+                arg: request.form[arg] for arg in FILTER_ARGS if request.form.get(arg)
+            }
+            
+            # Redirect to results page after getting form username
+            return redirect(url_for('results', username=form_username, **filter_args))
+        
+        return render_template('index.html', perf_types=PERF_TYPES)
+
+
+    @app.route('/results/<username>')
+    def results(username):
+        """Handle the results page for a specific user.
+
+        Retrieves the user's game data from lichess.org
+        analyses en passant statistics and updates the database,
+        then renders the results page. Game filters may be given
+        in the query string.
+
+        Analysis stops with a partial result once the request's time
+        limit runs out, and the next request for the user resumes it.
+
+        Returns:
+          Rendered HTML template for the results page, or the index
+          page with an error message and a non-2xx status code.
+        """
+        try:
+            filters = parse_filters(request.args)
+        except ValueError as e:
+            return render_template('index.html', perf_types=PERF_TYPES, error=str(e)), 400
+
+        try:
+            # Wait for any analysis of the same user by another worker
+            with analysis_job(db_name, username, limits['maxSeconds']):
+                (
+                    username,
+                    num_rated,
+                    num_casual,
+                    rated_games,
+                    casual_games
+                ) = retrieve_games(db_name, username, filters, limits)
+
+                results = analyse_games(
+                    db_name, username, rated_games, casual_games, filters,
+                    limits['maxSeconds']
+                )
+
+                if results['partial']:
+                    # Only record the games analysed so far
+                    num_rated, num_casual = results['ratedGames'], results['casualGames']
+
+                update_database(db_name, username, num_rated, num_casual, results, filters)
+        except (
+            TimeoutError,
+            LichessErrorHandler.APIError,
+            LichessErrorHandler.UserNotFoundError,
+            LichessErrorHandler.RateLimitError,
+            LichessErrorHandler.ServerError
+        ) as e:
+            # If HTTP error or the user is busy for too long,
+            # redirect back to index with error message
+            status = next(status for error, status in ERROR_STATUSES if isinstance(e, error))
+            return render_template('index.html', perf_types=PERF_TYPES, error=str(e)), status
+
+        filter_args = {arg: request.args[arg] for arg in FILTER_ARGS if request.args.get(arg)}
+
+        return render_template(
+            'results.html', username=username, results=results, filter_args=filter_args
+        )
+
+
+    @app.route('/leaderboards')
+    def leaderboards():
+        """Handle the leaderboards page for the application.
+
+        Retrieves leaderboard data for en passant statistics from
+        the database and renders leaderboards page.
+
+        Returns:
+          Rendered HTML template for the leaderboards page. 
+        """
+        percentage_results, declined_results = get_leaderboards(db_name)
+        return render_template(
+            'leaderboards.html',
+            percentage_results=percentage_results,
+            declined_results=declined_results
+        )
+
+
+    @app.route('/leaderboards/allowed')
+    def allowed():
+        """Handle the page of players who allow the most en passants.
+
+        Retrieves the players whose double pawn pushes gave their
+        opponents the most en passant opportunities, across both
+        colours of every analysed game, and renders the page.
+
+        Returns:
+          Rendered HTML template for the allowed leaderboard page.
+        """
+        return render_template(
+            'allowed.html', allowed_results=get_allowed_leaderboard(db_name)
+        )
+
+
+    @app.route('/head-to-head/<username>/<opponent>')
+    def head_to_head(username, opponent):
+        """Handle the head-to-head page for two players.
+
+        Retrieves the en passant opportunities each player allowed the
+        other in analysed games and renders the head-to-head page.
+
+        Returns:
+          Rendered HTML template for the head-to-head page.
+        """
+        return render_template(
+            'head_to_head.html',
+            username=username,
+            opponent=opponent,
+            head_to_head=get_head_to_head(db_name, username, opponent)
+        )
+
+
+    @app.route('/statistics')
+    def statistics():
+        """Handle the statistics page for the application.
+
+        Retrieves en passant statistics aggregated across all users,
+        by rating band, variant and opponent, and decline rates, and
+        renders the statistics page.
+
+        Returns:
+          Rendered HTML template for the statistics page.
+        """
+        return render_template('statistics.html', statistics=get_statistics(db_name))
+
+
+    if not admin:
+        return app
+
+    @app.route('/admin/costs')
+    def costs():
+        """Handle the analysis costs page for administrators.
+
+        Retrieves the time taken and halfmoves replayed to analyse
+        games per user and variant from the database, to spot
+        pathological inputs, and renders the costs page.
+
+        Returns:
+          Rendered HTML template for the costs page.
+        """
+        slowest_users, slowest_variants = get_analysis_costs(db_name)
+        return render_template(
+            'costs.html',
+            slowest_users=slowest_users,
+            slowest_variants=slowest_variants
+        )
+
+    return app
+
+
+if __name__ == '__main__':
     main()
\ No newline at end of file
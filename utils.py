@@ -1,232 +1,825 @@
-from database_manager import Database
-from chess_game_analyser import ChessGame
-from lichess_api import get_user_games, get_user_info
-
-
-def time_function(func):
-    """Decorator to record and print time taken to run a function."""
-    from time import time
-
-    def wrapper(*args, **kwargs):
-        start_time = time()
-        return_value = func(*args, **kwargs)
-        time_taken = time() - start_time
-        function_name = func.__name__.replace('_', ' ')
-        print(f"Time taken to {function_name}: {time_taken} seconds")
-        return return_value
-
-    return wrapper
-
-
-@time_function
-def retrieve_games(db_name, form_username):
-    """Retrieve new games for a user and return game data.
-
-    Retrieves new games for a case-insensitive username. If the user
-    exists in the database, only new games are retrieved to reduce
-    API calls. Otherwise, all games are retrieved.
-
-    Args:
-      db_name (str): The name of the SQLite database file.
-      form_username (str): The username entered by the user
-      (case-insensitive).
-
-    Returns:
-      tuple: A tuple containing:
-        - str: The case-sensitive username.
-        - int: The total number of rated games.
-        - int: The total number of casual games.
-        - list[str]: A list of new rated games (PGN strings).
-        - list[str]: A list of new casual games (PGN strings).
-    """
-    db = Database(db_name)
-    # Retrieve case-sensitive username and number of games
-    username, num_rated, num_casual = get_user_info(form_username)
-
-    # Retrieve all games if user not in database
-    if not db.user_exists(username):
-        rated_list = get_user_games(username, is_rated=True)
-        casual_list = get_user_games(username, is_rated=False)
-    
-    # Retrieve only new games not in database if user exists
-    else:
-        db_num_rated, db_num_casual = db.get_num_games(username)
-        rated_list = []
-        casual_list = []
-
-        # Retrieve new games
-        if db_num_rated < num_rated:
-            rated_list = get_user_games(
-                username, is_rated=True, num_new_games=num_rated-db_num_rated
-            )
-
-        if db_num_casual < num_casual:
-            casual_list = get_user_games(
-                username, is_rated=False, num_new_games=num_casual-db_num_casual
-            )
-
-    db.close()
-    return username, num_rated, num_casual, rated_list, casual_list
-
-
-@time_function
-def analyse_games(db_name, username, rated_list, casual_list):
-    """Analyse games for a user and return en passant statistics.
-
-    For new user, processes all games to calculate statistics.
-    For exisiting user, retrieves existing statistics from database
-    and processes new games, adding them together.
-
-    Args:
-      db_name (str): The name of the SQLite database file.
-      username (str): The case-sensitive username.
-      rated_list (list[str]): A list of new rated games (PGN strings).
-      casual_list (list[str]): A list of new casual games (PGN strings).
-
-    Returns:
-      dict: A dictionary containing total games,
-      en passant statistics and URL lists.
-    """
-    db = Database(db_name)
-
-    # Initialise values to results, assuming new user
-    results = {
-        'ratedGames': len(rated_list),
-        'casualGames': len(casual_list),
-        'ratedAccepted': 0,
-        'ratedDeclined': 0,
-        'ratedAcceptedList': [],
-        'ratedDeclinedList': [],
-        'casualAccepted': 0,
-        'casualDeclined': 0,
-        'casualAcceptedList': [],
-        'casualDeclinedList': []
-    }
-
-    if db.user_exists(username):
-        # Retrieve from database if user exists and update results
-        db_num_rated, db_num_casual = db.get_num_games(username)
-        results['ratedGames'] += db_num_rated
-        results['casualGames'] += db_num_casual
-
-        for game_type in ['rated', 'casual']:
-            (
-                results[f'{game_type}Accepted'],
-                results[f'{game_type}Declined']
-            ) = db.get_stats(username, game_type)
-
-            for accepted in [True, False]:
-                decision = 'Accepted' if accepted else 'Declined'
-                results[
-                    f'{game_type}{decision}List'
-                ] = db.get_urls(username, game_type, accepted)
-    
-    results['totalGames'] = results['ratedGames'] + results['casualGames']
-
-    def update_results(games_list, game_type):
-        """Helper function to update results dictionary for game_type."""
-        # Iterate through games to get en passant statistics
-        for pgn_string in games_list:
-            game = ChessGame(pgn_string, username)
-
-            en_passant_urls = game.get_en_passant_urls()
-
-            opponent = game.get_opponent()
-
-            for decision in ['accepted', 'declined']:
-                key = f'{game_type}{decision.capitalize()}'
-
-                results[key] += len(en_passant_urls[decision])
-
-                for url in en_passant_urls[decision]:
-                    # Store tuple of URL and opponent
-                    results[f'{key}List'].append((url, opponent))
-
-    update_results(rated_list, 'rated')
-    update_results(casual_list, 'casual')
-
-    # Calculate total en passant statistics and insert into results
-    results.update({
-        'ratedOpportunities': results['ratedAccepted'] + results['ratedDeclined'],
-        'casualOpportunities': results['casualAccepted'] + results['casualDeclined'],
-        'totalAccepted': results['ratedAccepted'] + results['casualAccepted'],
-        'totalDeclined': results['ratedDeclined'] + results['casualDeclined']
-    })
-    results['totalOpportunities'] = results['totalAccepted'] + results['totalDeclined']
-    
-    def percentage(numerator, denominator):
-        return round(numerator / denominator * 100, 2) if denominator != 0 else 0
-    
-    # Calculate percentages and insert into results
-    results.update({
-        'ratedPercentage': percentage(results['ratedAccepted'], results['ratedOpportunities']),
-        'casualPercentage': percentage(results['casualAccepted'], results['casualOpportunities']),
-        'totalPercentage': percentage(results['totalAccepted'], results['totalOpportunities'])
-    })
-
-    db.close()
-    return results
-
-
-@time_function
-def update_database(db_name, username, num_rated, num_casual, results):
-    """Update the database with new games and en passant statistics.
-
-    Args:
-      db_name (str): The name of the SQLite database file.
-      username (str): The case-sensitive username.
-      num_rated (int): The new total number of rated games.
-      num_casual (int): The new total number of casual games.
-      results (dict): A dictionary containing total games,
-      en passant statisitcs and URL lists.
-
-    Returns:
-      None
-    """
-    db = Database(db_name)
-
-    # Add user by inserting actual number of games
-    db.update_num_games(username, num_rated, num_casual)
-
-    # Insert updated en passant statistics to user_stats table
-    db.update_stats(username, 'rated', results['ratedAccepted'], results['ratedDeclined'])
-    db.update_stats(username, 'casual', results['casualAccepted'], results['casualDeclined'])
-
-    # Insert new URLs to user_urls table
-    for url, opponent in results['ratedAcceptedList']:
-        db.insert_url(username, opponent, 'rated', accepted=True, url=url)
-    for url, opponent in results['ratedDeclinedList']:
-        db.insert_url(username, opponent, 'rated', accepted=False, url=url)
-    for url, opponent in results['casualAcceptedList']:
-        db.insert_url(username, opponent, 'casual', accepted=True, url=url)
-    for url, opponent in results['casualDeclinedList']:
-        db.insert_url(username, opponent, 'casual', accepted=False, url=url)
-        
-    db.close()
-
-
-@time_function
-def get_leaderboards(db_name):
-    """Retrieve leaderboard data across users from the database.
-
-    Args:
-      db_name (str): The name of the SQLite database file.
-
-    Returns:
-      tuple: A tuple containing:
-        - list: Leaderboard data sorted by acceptance % containing:
-         - str: Username.
-         - int: Total opportunities to en passant.
-         - float: Accepted percentage.
-        - list: Leaderboard data sorted by declines containing:
-          - str: Username.
-          - int: Total number of games.
-          - int: Total number of opportunities declined.
-    """
-    db = Database(db_name)
-
-    percentage_results = db.get_percentage_leaderboard()
-    declined_results = db.get_declined_leaderboard()
-
-    db.close()
-    return percentage_results, declined_results
\ No newline at end of file
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from time import monotonic, sleep
+
+from database_manager import Database
+from game_stream import GameStream
+from lichess_api import (
+    LichessErrorHandler, stream_user_games, get_user_info,
+    VARIANT_PERF_TYPES, SPEED_PERF_TYPES, CLASSICAL, CORRESPONDENCE, COLORS
+)
+
+
+# Valid values of the 'perfType' game filter
+PERF_TYPES = (
+    [perf_type for _, perf_type in SPEED_PERF_TYPES]
+    + [CLASSICAL, CORRESPONDENCE]
+    + list(VARIANT_PERF_TYPES.values())
+)
+# Format of the 'since' and 'until' game filters in query strings
+FILTER_DATE_FORMAT = '%Y-%m-%d'
+
+# Seconds between checks whether another worker has finished a user
+JOB_POLL_INTERVAL = 0.5
+# Multiple of the time limit of a request after which an unfinished
+# analysis is considered abandoned, e.g. by a worker which crashed
+JOB_STALE_FACTOR = 3
+# Seconds added to the stale timeout for connecting to Lichess and
+# saving the results either side of the time limit
+JOB_STALE_MARGIN = 30
+# Multiple of the time limit of a request spent waiting for another
+# worker's analysis of the same user before giving up
+JOB_WAIT_FACTOR = 1.5
+
+# Default limits on the resources used to analyse games in one request
+DEFAULT_LIMITS = {
+    # Games downloaded ahead of their analysis
+    'maxGamesInFlight': 500,
+    # Size of the games downloaded ahead of their analysis
+    'maxBufferedBytes': 16 * 1024 * 1024,
+    # Seconds analysing games before returning a partial result
+    'maxSeconds': 60
+}
+# Games analysed between saving partial results to the database
+CHECKPOINT_INTERVAL = 500
+
+
+def time_function(func):
+    """Decorator to record and print time taken to run a function."""
+    from time import time
+
+    def wrapper(*args, **kwargs):
+        start_time = time()
+        return_value = func(*args, **kwargs)
+        time_taken = time() - start_time
+        function_name = func.__name__.replace('_', ' ')
+        print(f"Time taken to {function_name}: {time_taken} seconds")
+        return return_value
+
+    return wrapper
+
+
+@contextmanager
+def analysis_job(db_name, form_username, max_seconds=DEFAULT_LIMITS['maxSeconds']):
+    """Context manager allowing only one analysis of a user at a time.
+
+    Analyses read a user's stored statistics and add new games to them,
+    so concurrent analyses of the same user would count games twice.
+    Waits until any analysis of the user by another thread or process
+    sharing the database has finished, for a bounded time.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      form_username (str): The username entered by the user
+      (case-insensitive).
+      max_seconds (float, optional): The time limit of an analysis,
+      from which the time to wait for another analysis and the age
+      of an abandoned one are derived. Defaults to the default limit.
+
+    Raises:
+      TimeoutError: If another analysis of the user did not finish
+      in time.
+    """
+    db = Database(db_name)
+    stale_after = JOB_STALE_FACTOR * max_seconds + JOB_STALE_MARGIN
+    give_up_at = monotonic() + JOB_WAIT_FACTOR * max_seconds
+
+    try:
+        while not db.acquire_job(form_username, stale_after):
+            if monotonic() >= give_up_at:
+                raise TimeoutError(
+                    f"'{form_username}' is already being analysed, please try again shortly!"
+                )
+            sleep(JOB_POLL_INTERVAL)
+    except BaseException:
+        db.close()
+        raise
+
+    try:
+        yield
+    finally:
+        db.release_job(form_username)
+        db.close()
+
+
+def parse_filters(args):
+    """Parse and validate game filters from query string arguments.
+
+    Args:
+      args (dict): Query string arguments, optionally containing
+      'perfType', 'color', 'since' and 'until' (dates as YYYY-MM-DD).
+
+    Returns:
+      dict: The game filters, with dates converted to inclusive
+      timestamps in milliseconds. Empty if no filters are given.
+
+    Raises:
+      ValueError: If a filter value is invalid.
+    """
+    filters = {}
+
+    perf_type = args.get('perfType')
+    if perf_type:
+        if perf_type not in PERF_TYPES:
+            raise ValueError(f"Invalid time control or variant '{perf_type}'!")
+        filters['perfType'] = perf_type
+
+    color = args.get('color')
+    if color:
+        if color not in COLORS:
+            raise ValueError(f"Invalid colour '{color}'!")
+        filters['color'] = color
+
+    for param in ['since', 'until']:
+        date = args.get(param)
+        if not date:
+            continue
+
+        try:
+            start = datetime.strptime(date, FILTER_DATE_FORMAT).replace(tzinfo=timezone.utc)
+        except ValueError:
+            raise ValueError(f"Invalid date '{date}', expected YYYY-MM-DD!")
+
+        if param == 'until':
+            # Include all games played on the final day
+            start += timedelta(days=1)
+            filters[param] = int(start.timestamp() * 1000) - 1
+        else:
+            filters[param] = int(start.timestamp() * 1000)
+
+    return filters
+
+
+def get_filter_key(filters):
+    """Return a canonical key identifying a set of game filters."""
+    return '&'.join(f'{param}={filters[param]}' for param in sorted(filters))
+
+
+def get_new_game_filters(filters, last_game_at):
+    """Return game filters that only match games not yet analysed.
+
+    Args:
+      filters (dict): The game filters.
+      last_game_at (int): The timestamp in milliseconds of the latest
+      game already analysed for these filters, or `None`.
+
+    Returns:
+      dict: The game filters, with 'since' moved after `last_game_at`.
+    """
+    if last_game_at is None:
+        return filters
+
+    # Start times are recorded to the second, so resume from the next one
+    since = max(filters.get('since', 0), last_game_at + 1000)
+    return {**filters, 'since': since}
+
+
+def get_oldest_new_game_at(username, is_rated, num_new_games, limits, deadline):
+    """Return the start time of the oldest of a user's latest games.
+
+    Only the headers of the games are downloaded.
+
+    Args:
+      username (str): The case-sensitive username.
+      is_rated (bool): Whether to look at rated games (`True`) or
+      casual games (`False`).
+      num_new_games (int): The number of latest games.
+      limits (dict): The limits on games downloaded ahead.
+      deadline (float): The `time.monotonic()` time to give up by.
+
+    Returns:
+      int: The timestamp in milliseconds, or `None` if the user has
+      no such games.
+
+    Raises:
+      TimeoutError: If the headers were not all downloaded in time.
+    """
+    from chess_game_analyser import ChessGame
+
+    oldest_game_at = None
+    games = GameStream(
+        stream_user_games(username, is_rated, num_new_games, moves=False),
+        limits['maxGamesInFlight'],
+        limits['maxBufferedBytes'],
+        deadline
+    )
+
+    try:
+        # Games are streamed from newest to oldest
+        for pgn_string in games:
+            oldest_game_at = ChessGame(pgn_string, username, lazy=True).get_timestamp()
+    finally:
+        games.close()
+
+    if games.interrupted:
+        # Resuming from a newer game would skip games
+        raise TimeoutError(
+            f"Timed out finding the new games of '{username}', please try again!"
+        )
+
+    return oldest_game_at
+
+
+@time_function
+def retrieve_games(db_name, form_username, filters=None, limits=None):
+    """Retrieve new games for a user and return game data.
+
+    Retrieves new games for a case-insensitive username. If the user
+    exists in the database, only games after the latest one analysed
+    are retrieved to reduce API calls. Otherwise, all games are
+    retrieved.
+
+    If game filters are given, only matching games are retrieved,
+    starting after the latest game analysed for the same filters.
+
+    Games are streamed from oldest to newest as they are analysed,
+    with at most `limits['maxGamesInFlight']` games and
+    `limits['maxBufferedBytes']` of them downloaded ahead. The streams
+    stop waiting for games `limits['maxSeconds']` after retrieval
+    starts, marking them interrupted.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      form_username (str): The username entered by the user
+      (case-insensitive).
+      filters (dict, optional): The game filters from `parse_filters`.
+      Defaults to `None`.
+      limits (dict, optional): Limits overriding `DEFAULT_LIMITS`.
+      Defaults to `None`.
+
+    Returns:
+      tuple: A tuple containing:
+        - str: The case-sensitive username.
+        - int: The total number of rated games.
+        - int: The total number of casual games.
+        - GameStream: The new rated games (PGN strings).
+        - GameStream: The new casual games (PGN strings).
+
+    Raises:
+      TimeoutError: If the new games of a user analysed before the
+      latest game was recorded could not be found in time.
+    """
+    limits = {**DEFAULT_LIMITS, **(limits or {})}
+    deadline = monotonic() + limits['maxSeconds']
+    db = Database(db_name)
+    # Retrieve case-sensitive username and number of games
+    username, num_rated, num_casual = get_user_info(form_username)
+    game_streams = {}
+
+    for game_type, num_games in [('rated', num_rated), ('casual', num_casual)]:
+        is_rated = game_type == 'rated'
+        game_streams[game_type] = []
+
+        # Retrieve new games matching filters
+        if filters:
+            filter_stats = db.get_filter_stats(username, get_filter_key(filters), game_type)
+            last_game_at = filter_stats[3] if filter_stats is not None else None
+            new_game_filters = get_new_game_filters(filters, last_game_at)
+
+        # Retrieve all games if user not in database
+        elif not db.user_exists(username):
+            new_game_filters = {}
+
+        # Retrieve only new games not in database if user exists
+        else:
+            db_num_games = db.get_num_games(username)[0 if is_rated else 1]
+            if db_num_games >= num_games:
+                continue
+
+            stats = db.get_stats(username, game_type)
+            last_game_at = stats[2] if stats is not None else None
+
+            if last_game_at is not None:
+                new_game_filters = get_new_game_filters({}, last_game_at)
+            elif db_num_games == 0:
+                # None analysed yet, e.g. a partial analysis stopped
+                # before reaching this game type
+                new_game_filters = {}
+            else:
+                # Users analysed before the latest game was recorded
+                # resume from the oldest game not in the database
+                oldest_game_at = get_oldest_new_game_at(
+                    username, is_rated, num_games - db_num_games, limits, deadline
+                )
+                if oldest_game_at is None:
+                    continue
+                new_game_filters = {'since': oldest_game_at}
+
+        game_streams[game_type] = GameStream(
+            stream_user_games(
+                username, is_rated, filters=new_game_filters, oldest_first=True
+            ),
+            limits['maxGamesInFlight'],
+            limits['maxBufferedBytes'],
+            deadline
+        )
+
+    db.close()
+    return username, num_rated, num_casual, game_streams['rated'], game_streams['casual']
+
+
+@time_function
+def analyse_games(db_name, username, rated_list, casual_list, filters=None,
+                  max_seconds=None):
+    """Analyse games for a user and return en passant statistics.
+
+    For new user, processes all games to calculate statistics.
+    For exisiting user, retrieves existing statistics from database
+    and processes new games, adding them together.
+
+    If game filters are given, games not matching them are skipped and
+    existing statistics are retrieved for the same filters instead.
+
+    Every `CHECKPOINT_INTERVAL` games, the results so far are saved to
+    the database with `update_database`. If `max_seconds` runs out or
+    a download fails or runs out of time, analysis stops early with a
+    partial result, and the next analysis of the user resumes after
+    the last game analysed. The same goes for Lichess errors part way
+    through a download, unless no games were analysed yet.
+
+    The next analysis resumes after the second the last game analysed
+    started in, so analysis only stops between games started in
+    different seconds, and games of a second which may not have been
+    downloaded in full are left for the next analysis.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      username (str): The case-sensitive username.
+      rated_list (iterable[str]): The new rated games (PGN strings),
+      from oldest to newest.
+      casual_list (iterable[str]): The new casual games (PGN strings),
+      from oldest to newest.
+      filters (dict, optional): The game filters from `parse_filters`.
+      Defaults to `None`.
+      max_seconds (float, optional): The max seconds to analyse games
+      for. Defaults to `None`, which is unlimited.
+
+    Returns:
+      dict: A dictionary containing total games,
+      en passant statistics and URL lists. 'partial' is True if
+      not all new games were analysed.
+
+    Raises:
+      APIError: If Lichess responded with an error before any games
+      were analysed.
+    """
+    # Imported on first analysis to keep startup of the web process light
+    from chess_game_analyser import ChessGame
+
+    db = Database(db_name)
+
+    start_time = monotonic()
+
+    # Initialise values to results, assuming new user
+    results = {
+        'ratedGames': 0,
+        'casualGames': 0,
+        'ratedLastGameAt': None,
+        'casualLastGameAt': None,
+        'ratedAccepted': 0,
+        'ratedDeclined': 0,
+        'ratedAcceptedList': [],
+        'ratedDeclinedList': [],
+        'casualAccepted': 0,
+        'casualDeclined': 0,
+        'casualAcceptedList': [],
+        'casualDeclinedList': []
+    }
+
+    if filters:
+        filter_key = get_filter_key(filters)
+
+        for game_type in ['rated', 'casual']:
+            filter_stats = db.get_filter_stats(username, filter_key, game_type)
+            if filter_stats is None:
+                continue
+
+            # Retrieve from database if filters were analysed before
+            (
+                results[f'{game_type}Games'],
+                results[f'{game_type}Accepted'],
+                results[f'{game_type}Declined'],
+                results[f'{game_type}LastGameAt']
+            ) = filter_stats
+
+            for accepted in [True, False]:
+                decision = 'Accepted' if accepted else 'Declined'
+                results[
+                    f'{game_type}{decision}List'
+                ] = db.get_filter_urls(username, filter_key, game_type, accepted)
+
+    elif db.user_exists(username):
+        # Retrieve from database if user exists and update results
+        db_num_rated, db_num_casual = db.get_num_games(username)
+        results['ratedGames'] += db_num_rated
+        results['casualGames'] += db_num_casual
+
+        for game_type in ['rated', 'casual']:
+            (
+                results[f'{game_type}Accepted'],
+                results[f'{game_type}Declined'],
+                results[f'{game_type}LastGameAt']
+            ) = db.get_stats(username, game_type)
+
+            for accepted in [True, False]:
+                decision = 'Accepted' if accepted else 'Declined'
+                results[
+                    f'{game_type}{decision}List'
+                ] = db.get_urls(username, game_type, accepted)
+    
+    # Whether analysis stopped before all new games
+    results['partial'] = False
+
+    def reset_new_results():
+        """Helper function to forget new results saved to the database."""
+        # Cost of analysing the new games per variant
+        results['costs'] = {}
+        # New URLs with game type, decision, opponent, rating and variant
+        results['newUrls'] = []
+        # En passant opportunities of both players in the new games
+        results['opportunities'] = []
+
+    reset_new_results()
+    # Number of games analysed since results were last saved
+    num_unsaved = 0
+    # Number of games analysed by this call
+    num_analysed = 0
+
+    def analyse_game(game, game_type):
+        """Helper function to add the results of a game for game_type."""
+        nonlocal num_unsaved, num_analysed
+
+        results[f'{game_type}Games'] += 1
+        results[f'{game_type}LastGameAt'] = max(
+            results[f'{game_type}LastGameAt'] or 0, game.get_timestamp()
+        )
+
+        # Opportunities of both players, for the opponent index
+        opportunities = game.get_en_passant_opportunities()
+
+        cost = game.get_analysis_cost()
+        variant_costs = results['costs'].setdefault(cost['variant'], {
+            'games': 0, 'halfmoves': 0, 'seconds': 0.0, 'aborted': 0,
+            'maxSeconds': 0.0, 'slowestUrl': None
+        })
+        variant_costs['games'] += 1
+        variant_costs['halfmoves'] += cost['halfmoves']
+        variant_costs['seconds'] += cost['seconds']
+        variant_costs['aborted'] += cost['aborted']
+        if variant_costs['slowestUrl'] is None or cost['seconds'] > variant_costs['maxSeconds']:
+            variant_costs['maxSeconds'] = cost['seconds']
+            variant_costs['slowestUrl'] = game.get_url()
+
+        for player, allowed_by, url, accepted in opportunities:
+            results['opportunities'].append(
+                (player, allowed_by, game_type, accepted, url)
+            )
+
+            if player != username:
+                continue
+
+            key = f"{game_type}{'Accepted' if accepted else 'Declined'}"
+            results[key] += 1
+            # Store tuple of URL and opponent
+            results[f'{key}List'].append((url, allowed_by))
+            results['newUrls'].append((
+                game_type, accepted, url, allowed_by,
+                game.get_user_rating(), game.get_variant()
+            ))
+
+        num_unsaved += 1
+        num_analysed += 1
+
+    def update_results(games_list, game_type):
+        """Helper function to update results dictionary for game_type."""
+        nonlocal num_unsaved
+
+        # Only games after those already analysed are new
+        new_game_filters = get_new_game_filters(
+            filters or {}, results[f'{game_type}LastGameAt']
+        )
+
+        # Games started in the same second are analysed together once
+        # a game from a later second arrives
+        pending_games = []
+        pending_at = None
+
+        # Iterate through games to get en passant statistics
+        for pgn_string in games_list:
+            game = ChessGame(pgn_string, username, lazy=True)
+
+            # Games are filtered by Lichess, but check just in case
+            if not game.matches_filters(new_game_filters):
+                continue
+
+            timestamp = game.get_timestamp()
+            if pending_games and timestamp != pending_at:
+                for pending_game in pending_games:
+                    analyse_game(pending_game, game_type)
+                pending_games.clear()
+
+                if num_unsaved >= CHECKPOINT_INTERVAL:
+                    # Save progress in case analysis stops early
+                    update_database(
+                        db_name, username, results['ratedGames'], results['casualGames'],
+                        results, filters
+                    )
+                    reset_new_results()
+                    num_unsaved = 0
+
+                if max_seconds is not None and monotonic() - start_time > max_seconds:
+                    # Out of time, the next analysis resumes from here
+                    results['partial'] = True
+                    return
+
+            pending_games.append(game)
+            pending_at = timestamp
+
+        if getattr(games_list, 'interrupted', False):
+            # Download failed or stalled, the next analysis resumes
+            # from here, including games of the last second seen
+            results['partial'] = True
+            return
+
+        for pending_game in pending_games:
+            analyse_game(pending_game, game_type)
+
+    try:
+        update_results(rated_list, 'rated')
+        if not results['partial']:
+            update_results(casual_list, 'casual')
+    except LichessErrorHandler.APIError:
+        if num_analysed == 0:
+            raise
+        # Lichess refused the rest of the games, e.g. when rate limited,
+        # so save those analysed and let the next analysis resume
+        results['partial'] = True
+    finally:
+        # Stop any downloads still in progress
+        for games_list in [rated_list, casual_list]:
+            if isinstance(games_list, GameStream):
+                games_list.close()
+
+    results['totalGames'] = results['ratedGames'] + results['casualGames']
+
+    # Calculate total en passant statistics and insert into results
+    results.update({
+        'ratedOpportunities': results['ratedAccepted'] + results['ratedDeclined'],
+        'casualOpportunities': results['casualAccepted'] + results['casualDeclined'],
+        'totalAccepted': results['ratedAccepted'] + results['casualAccepted'],
+        'totalDeclined': results['ratedDeclined'] + results['casualDeclined']
+    })
+    results['totalOpportunities'] = results['totalAccepted'] + results['totalDeclined']
+    
+    def percentage(numerator, denominator):
+        return round(numerator / denominator * 100, 2) if denominator != 0 else 0
+    
+    # Calculate percentages and insert into results
+    results.update({
+        'ratedPercentage': percentage(results['ratedAccepted'], results['ratedOpportunities']),
+        'casualPercentage': percentage(results['casualAccepted'], results['casualOpportunities']),
+        'totalPercentage': percentage(results['totalAccepted'], results['totalOpportunities'])
+    })
+
+    db.close()
+    return results
+
+
+@time_function
+def update_database(db_name, username, num_rated, num_casual, results, filters=None):
+    """Update the database with new games and en passant statistics.
+
+    If game filters are given, statistics are stored for those filters
+    only, leaving the user's overall statistics and analysis costs
+    unchanged. Filtered analyses overlap with each other and with the
+    user's unfiltered analysis, so their costs are not recorded, and
+    users who were only analysed with filters have no costs.
+
+    Only the URLs, costs and opportunities found since the results were
+    last saved are inserted, so partial results can be saved as
+    analysis progresses. Everything is written in one transaction, so
+    a failed save leaves the database at the previous save.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      username (str): The case-sensitive username.
+      num_rated (int): The new total number of rated games, or those
+      analysed so far if the results are partial.
+      num_casual (int): The new total number of casual games, or those
+      analysed so far if the results are partial.
+      results (dict): A dictionary containing total games,
+      en passant statisitcs and URL lists.
+      filters (dict, optional): The game filters from `parse_filters`.
+      Defaults to `None`.
+
+    Returns:
+      None
+    """
+    db = Database(db_name)
+
+    try:
+        db.conn.execute('BEGIN IMMEDIATE')
+        _save_results(db, username, num_rated, num_casual, results, filters)
+        db.conn.commit()
+    except BaseException:
+        db.conn.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def _save_results(db, username, num_rated, num_casual, results, filters):
+    """Write the results of `update_database` without committing."""
+    # Index opportunities of both players by who allowed them
+    for player, allowed_by, game_type, accepted, url in results['opportunities']:
+        db.insert_opportunity(player, allowed_by, game_type, accepted, url)
+
+    if filters:
+        filter_key = get_filter_key(filters)
+
+        for game_type in ['rated', 'casual']:
+            db.update_filter_stats(
+                username, filter_key, game_type,
+                results[f'{game_type}Games'],
+                results[f'{game_type}Accepted'],
+                results[f'{game_type}Declined'],
+                results[f'{game_type}LastGameAt']
+            )
+
+        # Insert new URLs to filter_urls table
+        for game_type, accepted, url, opponent, _, _ in results['newUrls']:
+            db.insert_filter_url(username, filter_key, opponent, game_type, accepted, url)
+
+        return
+
+    # Add cost of analysing the new games, which are analysed once
+    # without filters
+    for variant, variant_costs in results['costs'].items():
+        db.add_game_costs(
+            username, variant,
+            variant_costs['games'],
+            variant_costs['halfmoves'],
+            variant_costs['seconds'],
+            variant_costs['aborted'],
+            variant_costs['maxSeconds'],
+            variant_costs['slowestUrl']
+        )
+
+    # Add user by inserting actual number of games
+    db.update_num_games(username, num_rated, num_casual)
+
+    # Insert updated en passant statistics to user_stats table
+    for game_type in ['rated', 'casual']:
+        db.update_stats(
+            username, game_type,
+            results[f'{game_type}Accepted'],
+            results[f'{game_type}Declined'],
+            results[f'{game_type}LastGameAt']
+        )
+
+    # Insert new URLs to user_urls table
+    for game_type, accepted, url, opponent, rating, variant in results['newUrls']:
+        db.insert_url(
+            username, opponent, game_type, accepted=accepted, url=url,
+            rating=rating, variant=variant
+        )
+
+
+@time_function
+def get_leaderboards(db_name):
+    """Retrieve leaderboard data across users from the database.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+
+    Returns:
+      tuple: A tuple containing:
+        - list: Leaderboard data sorted by acceptance % containing:
+         - str: Username.
+         - int: Total opportunities to en passant.
+         - float: Accepted percentage.
+        - list: Leaderboard data sorted by declines containing:
+          - str: Username.
+          - int: Total number of games.
+          - int: Total number of opportunities declined.
+    """
+    db = Database(db_name)
+
+    percentage_results = db.get_percentage_leaderboard()
+    declined_results = db.get_declined_leaderboard()
+
+    db.close()
+    return percentage_results, declined_results
+
+
+@time_function
+def get_allowed_leaderboard(db_name, limit=50):
+    """Retrieve the players who allowed the most en passants.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      limit (int, optional): The max number of players to retrieve.
+      Defaults to 50.
+
+    Returns:
+      list: See `Database.get_allowed_leaderboard`.
+    """
+    db = Database(db_name)
+
+    allowed_results = db.get_allowed_leaderboard(limit)
+
+    db.close()
+    return allowed_results
+
+
+@time_function
+def get_head_to_head(db_name, username, opponent):
+    """Retrieve the en passant opportunities between two players.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      username (str): The case-insensitive username of one player.
+      opponent (str): The case-insensitive username of the other.
+
+    Returns:
+      dict: A dictionary with keys 'user' and 'opponent', each mapped
+      to a dictionary of the opportunities that player had:
+        - 'accepted' (list): URLs where en passant was accepted.
+        - 'declined' (list): URLs where en passant was declined.
+        - 'percentage' (float): The percentage accepted.
+    """
+    db = Database(db_name)
+
+    head_to_head = {}
+    for key, player, allowed_by in [
+        ('user', username, opponent),
+        ('opponent', opponent, username)
+    ]:
+        rows = db.get_head_to_head(player, allowed_by)
+        accepted = [url for url, is_accepted in rows if is_accepted]
+        declined = [url for url, is_accepted in rows if not is_accepted]
+
+        head_to_head[key] = {
+            'accepted': accepted,
+            'declined': declined,
+            'percentage': round(len(accepted) / len(rows) * 100, 2) if rows else 0
+        }
+
+    db.close()
+    return head_to_head
+
+
+@time_function
+def get_statistics(db_name, limit=50):
+    """Retrieve en passant statistics aggregated across all users.
+
+    Aggregations run on a columnar snapshot of the database which is
+    refreshed periodically, see `analytics.get_snapshot`.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      limit (int, optional): The max number of rows of the opponent
+      and declines tables. Defaults to 50.
+
+    Returns:
+      dict: A dictionary with keys:
+        - 'ratingBands': See `StatsSnapshot.acceptance_by_rating_band`.
+        - 'variants': See `StatsSnapshot.acceptance_by_variant`.
+        - 'opponents': See `StatsSnapshot.acceptance_by_opponent`.
+        - 'declineRates': See
+          `StatsSnapshot.declines_per_thousand_games`.
+    """
+    from analytics import get_snapshot
+
+    snapshot = get_snapshot(db_name)
+
+    return {
+        'ratingBands': snapshot.acceptance_by_rating_band(),
+        'variants': snapshot.acceptance_by_variant(),
+        'opponents': snapshot.acceptance_by_opponent(limit=limit),
+        'declineRates': snapshot.declines_per_thousand_games(limit=limit)
+    }
+
+
+@time_function
+def get_analysis_costs(db_name, limit=50):
+    """Retrieve the cost of analysing games across users and variants.
+
+    Args:
+      db_name (str): The name of the SQLite database file.
+      limit (int, optional): The max number of users to retrieve.
+      Defaults to 50.
+
+    Returns:
+      tuple: A tuple containing:
+        - list: The slowest users, see `Database.get_slowest_users`.
+        - list: The slowest variants, see
+          `Database.get_slowest_variants`.
+    """
+    db = Database(db_name)
+
+    slowest_users = db.get_slowest_users(limit)
+    slowest_variants = db.get_slowest_variants()
+
+    db.close()
+    return slowest_users, slowest_variants
\ No newline at end of file